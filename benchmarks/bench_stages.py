@@ -0,0 +1,161 @@
+"""
+Đo thời gian và bộ nhớ đỉnh của từng công đoạn chuyển đổi bảng kê -> UpSSE.xlsx trên bảng kê giả lập.
+
+Ví dụ:
+    python benchmarks/bench_stages.py                                  # 1k, 10k, 100k dòng, engine loop
+    python benchmarks/bench_stages.py --sizes 1000,500000 --engines loop,pandas --repeat 3
+    python benchmarks/bench_stages.py --formats xlsx,csv,tsv,parquet        # so sánh các định dạng file kết quả
+
+Các công đoạn:
+    static_parse   đọc Data.xlsx bằng openpyxl (load_static_data)
+    static_load    nạp bảng tra cứu qua snapshot JSON (load_static_data_snapshot, không tính bộ nhớ đệm trong tiến trình)
+    ingest         đọc bảng kê dạng luồng (iter_bkhd_rows)
+    transform      dựng dòng hóa đơn và dòng TMT theo hóa đơn (engine loop hoặc pandas)
+    summaries      dòng tổng hợp "Người mua không lấy hóa đơn" và dòng TMT tổng hợp
+    write_<fmt>    ghi file kết quả vào BytesIO theo từng định dạng của --formats (write_xlsx, write_csv, write_tsv, write_parquet)
+Cột tổng là một lượt chuyển đổi thực tế: static_load, ingest, transform, summaries và ghi định dạng đầu tiên của --formats;
+static_parse chỉ để so sánh với static_load, không tính vào tổng.
+Mỗi kết quả (một cỡ bảng kê x một engine) được ghi thêm một dòng JSON vào file --results.
+Bộ nhớ đỉnh đo bằng tracemalloc trong một lượt chạy riêng, để không làm sai lệch thời gian.
+"""
+import argparse
+import io
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+from contextlib import contextmanager
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(BENCH_DIR))
+import openpyxl
+import upsse_core
+from upsse_core import (headers, load_static_data, load_static_data_snapshot, iter_bkhd_rows, get_row_engine, get_chxd_rules,
+                        build_no_invoice_summary_rows, clean_string)
+from upsse_writer import OUTPUT_FORMATS, get_output_format
+from generate_bang_ke import generate_bang_ke, ky_hieu_for_chxd, DEFAULT_DATA_PATH, DEFAULT_CHXD
+
+DEFAULT_SIZES = "1000,10000,100000"
+BASE_STAGES = ["static_parse", "static_load", "ingest", "transform", "summaries"]
+REFERENCE_STAGES = {"static_parse"} # Một lượt chuyển đổi nạp snapshot (static_load), không đọc lại Data.xlsx
+
+# --- Đo từng công đoạn ---
+@contextmanager
+def _timed(results, name):
+    started = time.perf_counter()
+    yield
+    results[name] = time.perf_counter() - started
+
+@contextmanager
+def _traced(results, name):
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    yield
+    results[name] = (tracemalloc.get_traced_memory()[1] - base) / (1 << 20)
+
+def run_stages(bkhd_path, data_path, chxd_name, engine, formats, measure, results):
+    """Chạy lần lượt các công đoạn, ghi số đo của mỗi công đoạn vào results. Trả về các dòng UpSSE và kích thước file của từng định dạng."""
+    with measure(results, "static_parse"):
+        load_static_data(data_path)
+    upsse_core._static_data_memo.clear() # Đo đường nạp snapshot, không phải bộ nhớ đệm trong tiến trình
+    with measure(results, "static_load"):
+        static_data = load_static_data_snapshot(data_path)
+    rules = get_chxd_rules(static_data, chxd_name)
+
+    with measure(results, "ingest"):
+        bkhd_rows = list(iter_bkhd_rows(bkhd_path, rules.f5_full))
+    with measure(results, "transform"):
+        final_rows, all_tmt_rows, no_invoice_totals = get_row_engine(engine)(bkhd_rows, rules)
+    with measure(results, "summaries"):
+        summary_rows, tmt_summary_rows = build_no_invoice_summary_rows(no_invoice_totals, rules)
+    rows = final_rows + summary_rows + all_tmt_rows + tmt_summary_rows
+    output_bytes = {}
+    for name in formats: # Cùng các dòng UpSSE, chỉ khác cách ghi
+        output = io.BytesIO()
+        with measure(results, f"write_{name}"):
+            get_output_format(name).write(headers, rows, output)
+        output_bytes[name] = output.getbuffer().nbytes
+    return rows, output_bytes
+
+def bench_file(bkhd_path, data_path, chxd_name, engine, formats=("xlsx",), repeat=1, memory=True):
+    """Thời gian tốt nhất trong repeat lần chạy và bộ nhớ đỉnh (MB) của từng công đoạn."""
+    best = {}
+    for _ in range(repeat):
+        seconds = {}
+        rows, output_bytes = run_stages(bkhd_path, data_path, chxd_name, engine, formats, _timed, seconds)
+        best = {s: min(v, best.get(s, v)) for s, v in seconds.items()}
+    peak_mb = {}
+    if memory:
+        tracemalloc.start()
+        try: run_stages(bkhd_path, data_path, chxd_name, engine, formats, _traced, peak_mb)
+        finally: tracemalloc.stop()
+    return rows, output_bytes, best, peak_mb
+
+def total_seconds(seconds, formats):
+    """Thời gian một lượt chuyển đổi: các công đoạn chung (trừ REFERENCE_STAGES) và ghi định dạng đầu tiên."""
+    return sum(seconds[s] for s in BASE_STAGES + [f"write_{formats[0]}"] if s not in REFERENCE_STAGES)
+
+def bench_input_path(data_dir, n_rows, ky_hieu):
+    """Bảng kê giả lập được sinh một lần cho mỗi cỡ và dùng lại ở các lần chạy sau."""
+    path = os.path.join(data_dir, f"bang_ke_{ky_hieu}_{n_rows}.xlsx")
+    if not os.path.exists(path):
+        os.makedirs(data_dir, exist_ok=True)
+        print(f"Sinh bảng kê {n_rows} dòng: {path}", flush=True)
+        generate_bang_ke(path, n_rows, ky_hieu)
+    return path
+
+def environment_info():
+    info = {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count(),
+            "openpyxl": openpyxl.__version__}
+    for module_name in ("pandas", "pyarrow"):
+        try: info[module_name] = __import__(module_name).__version__
+        except ImportError: pass
+    return info
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo hiệu năng từng công đoạn chuyển đổi bảng kê -> UpSSE.xlsx.")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help=f"Các cỡ bảng kê (số dòng), cách nhau bởi dấu phẩy (mặc định: {DEFAULT_SIZES})")
+    parser.add_argument("--engines", default="loop", help="Các engine cần đo: loop, pandas (mặc định: loop)")
+    parser.add_argument("--formats", default="xlsx", help=f"Các định dạng file kết quả cần đo: {', '.join(OUTPUT_FORMATS)} (mặc định: xlsx)")
+    parser.add_argument("--chxd", default=DEFAULT_CHXD, help=f"CHXD của bảng kê giả lập (mặc định: {DEFAULT_CHXD})")
+    parser.add_argument("--data", default=DEFAULT_DATA_PATH, help="Đường dẫn Data.xlsx")
+    parser.add_argument("--data-dir", default=os.path.join(BENCH_DIR, "data"), help="Thư mục chứa bảng kê giả lập")
+    parser.add_argument("--repeat", type=int, default=1, help="Số lần đo thời gian, lấy lần nhanh nhất (mặc định: 1)")
+    parser.add_argument("--no-memory", action="store_true", help="Bỏ qua lượt đo bộ nhớ đỉnh")
+    parser.add_argument("--results", default="bench_results.jsonl", help="File JSON Lines ghi kết quả (mặc định: bench_results.jsonl)")
+    args = parser.parse_args(argv)
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    engines = [e.strip() for e in args.engines.split(",") if e.strip()]
+    formats = [get_output_format(f.strip()).name for f in args.formats.split(",") if f.strip()]
+    stages = BASE_STAGES + [f"write_{name}" for name in formats]
+    chxd_name = clean_string(args.chxd)
+    ky_hieu = ky_hieu_for_chxd(load_static_data_snapshot(args.data), chxd_name)
+    run_info = {"timestamp": datetime.now().isoformat(timespec="seconds"), "chxd": chxd_name, **environment_info()}
+
+    print(f"{'dòng':>8} {'engine':7} " + " ".join(f"{s:>13}" for s in stages) + f" {'tổng':>8} {'MB đỉnh':>8}")
+    with open(args.results, "a", encoding="utf-8") as results_file:
+        for n_rows in sizes:
+            bkhd_path = bench_input_path(args.data_dir, n_rows, ky_hieu)
+            reference_rows = None
+            for engine in engines:
+                rows, output_bytes, seconds, peak_mb = bench_file(bkhd_path, args.data, chxd_name, engine, formats, args.repeat, not args.no_memory)
+                parity = None
+                if reference_rows is None: reference_rows = rows
+                else: parity = [r.to_cells() for r in rows] == [r.to_cells() for r in reference_rows] # Các engine phải cho kết quả giống hệt nhau
+                record = {**run_info, "rows": n_rows, "engine": engine, "output_rows": len(rows), "output_bytes": output_bytes,
+                          "input_bytes": os.path.getsize(bkhd_path), "repeat": args.repeat,
+                          "seconds": {s: round(v, 4) for s, v in seconds.items()}, "total_seconds": round(total_seconds(seconds, formats), 4),
+                          "peak_mb": {s: round(v, 2) for s, v in peak_mb.items()}, "parity": parity}
+                results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+                results_file.flush()
+                print(f"{n_rows:>8} {engine:7} " + " ".join(f"{seconds[s]:>12.3f}s" for s in stages)
+                      + f" {record['total_seconds']:>7.2f}s {max(peak_mb.values(), default=0):>8.1f}"
+                      + ("" if parity is not False else "  KHÁC KẾT QUẢ!"), flush=True)
+    print(f"Kết quả đã ghi vào {args.results}")
+
+if __name__ == "__main__":
+    main()
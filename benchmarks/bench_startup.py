@@ -0,0 +1,132 @@
+"""
+Đo thời gian khởi động và thời gian chạy lại trang của giao diện Streamlit (streamlit_app.py), so với mục tiêu.
+
+Ví dụ:
+    python benchmarks/bench_startup.py                  # 3 lần khởi động nguội, 10 lần chạy lại mỗi lần
+    python benchmarks/bench_startup.py --repeat 5 --reruns 20
+
+Các số đo (mỗi lần khởi động nguội là một tiến trình Python mới):
+    import          thời gian import các module upsse_* mà giao diện dùng; openpyxl, pandas không được nạp ở bước này
+    first_render    từ lúc chạy tiến trình đến khi lần chạy đầu tiên của trang xong (gồm cả import streamlit), đo bằng AppTest
+    rerun           trung vị thời gian chạy lại cả trang khi đổi CHXD (AppTest luôn chạy lại cả trang,
+                    trên server thật thao tác trong phần chọn file chỉ chạy lại fragment nên còn nhanh hơn)
+Cần streamlit. Kết quả được ghi thêm một dòng JSON vào file --results; mã thoát 1 nếu có số đo vượt mục tiêu.
+"""
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import time
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.dirname(BENCH_DIR)
+APP_PATH = os.path.join(APP_DIR, "streamlit_app.py")
+APP_MODULES = ["upsse_core", "upsse_cache", "upsse_multi", "upsse_ledger", "upsse_jobs", "upsse_writer"]
+HEAVY_MODULES = ["openpyxl", "pandas", "pyarrow"] # Chỉ được nạp khi bắt đầu xử lý
+
+IMPORT_TARGET_SECONDS = 0.2
+FIRST_RENDER_TARGET_SECONDS = 2.0
+RERUN_TARGET_SECONDS = 0.15
+RERUN_CHXD = ["Nam Hồng", "Giao Thủy", "Phủ Lý"]
+
+# --- Đo trong tiến trình con (được gọi lại chính file này với --child) ---
+def _child_import():
+    started = time.perf_counter()
+    for module_name in APP_MODULES:
+        __import__(module_name)
+    return {"import_seconds": time.perf_counter() - started, "heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules]}
+
+def _child_app(reruns):
+    from streamlit.testing.v1 import AppTest
+    at = AppTest.from_file(APP_PATH, default_timeout=60)
+    at.run()
+    first_render_at = time.time()
+    errors = [str(e.value) for e in at.exception] + [str(e.value) for e in at.error]
+    rerun_seconds = []
+    for i in range(reruns):
+        at.selectbox(key="selected_chxd").select(RERUN_CHXD[i % len(RERUN_CHXD)])
+        started = time.perf_counter()
+        at.run()
+        rerun_seconds.append(time.perf_counter() - started)
+    return {"first_render_at": first_render_at, "rerun_seconds": rerun_seconds, "errors": errors,
+            "heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules]}
+
+def _run_child(kind, reruns=0):
+    started_at = time.time()
+    proc = subprocess.run([sys.executable, os.path.abspath(__file__), "--child", kind, "--reruns", str(reruns)],
+                          cwd=APP_DIR, capture_output=True, text=True, encoding="utf-8")
+    if proc.returncode != 0:
+        raise RuntimeError(proc.stderr.strip().splitlines()[-1] if proc.stderr.strip() else f"mã thoát {proc.returncode}")
+    return started_at, json.loads(proc.stdout.strip().splitlines()[-1])
+
+# --- Đo và so với mục tiêu ---
+def bench_startup(repeat=3, reruns=10):
+    """Trung vị các số đo qua repeat lần khởi động nguội."""
+    import_seconds, first_render_seconds, rerun_seconds, heavy_modules, errors = [], [], [], set(), []
+    for _ in range(repeat):
+        _, result = _run_child("import")
+        import_seconds.append(result["import_seconds"])
+        heavy_modules.update(result["heavy_modules"])
+        started_at, result = _run_child("app", reruns)
+        first_render_seconds.append(result["first_render_at"] - started_at)
+        rerun_seconds.extend(result["rerun_seconds"])
+        errors.extend(result["errors"])
+    return {"import_seconds": statistics.median(import_seconds), "first_render_seconds": statistics.median(first_render_seconds),
+            "rerun_seconds": statistics.median(rerun_seconds) if rerun_seconds else None,
+            "rerun_max_seconds": max(rerun_seconds, default=None), "heavy_modules_at_import": sorted(heavy_modules), "errors": errors}
+
+def check_targets(result, targets):
+    """Danh sách các số đo không đạt mục tiêu (rỗng nếu đạt hết)."""
+    failures = [f"{name}: {result[name]:.3f}s > {target:.3f}s" for name, target in targets.items() if result[name] is not None and result[name] > target]
+    if result["heavy_modules_at_import"]: failures.append(f"import đã nạp {', '.join(result['heavy_modules_at_import'])}")
+    if result["errors"]: failures.append(f"trang báo lỗi: {result['errors'][0]}")
+    return failures
+
+def environment_info():
+    info = {"python": platform.python_version(), "platform": platform.platform(), "cpu_count": os.cpu_count()}
+    try: info["streamlit"] = __import__("streamlit").__version__
+    except ImportError: pass
+    return info
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Đo thời gian khởi động và chạy lại trang của giao diện Streamlit.")
+    parser.add_argument("--repeat", type=int, default=3, help="Số lần khởi động nguội, lấy trung vị (mặc định: 3)")
+    parser.add_argument("--reruns", type=int, default=10, help="Số lần chạy lại trang sau mỗi lần khởi động (mặc định: 10)")
+    parser.add_argument("--import-target", type=float, default=IMPORT_TARGET_SECONDS, help=f"Mục tiêu import, giây (mặc định: {IMPORT_TARGET_SECONDS})")
+    parser.add_argument("--first-render-target", type=float, default=FIRST_RENDER_TARGET_SECONDS, help=f"Mục tiêu hiển thị lần đầu, giây (mặc định: {FIRST_RENDER_TARGET_SECONDS})")
+    parser.add_argument("--rerun-target", type=float, default=RERUN_TARGET_SECONDS, help=f"Mục tiêu chạy lại trang, giây (mặc định: {RERUN_TARGET_SECONDS})")
+    parser.add_argument("--results", default="bench_results.jsonl", help="File JSON Lines ghi kết quả (mặc định: bench_results.jsonl)")
+    parser.add_argument("--child", choices=["import", "app"], help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.child:
+        sys.path.insert(0, APP_DIR)
+        print(json.dumps(_child_import() if args.child == "import" else _child_app(args.reruns)))
+        return 0
+
+    try:
+        result = bench_startup(args.repeat, args.reruns)
+    except RuntimeError as e:
+        print(f"Không đo được (cần cài streamlit): {e}", file=sys.stderr)
+        return 2
+    targets = {"import_seconds": args.import_target, "first_render_seconds": args.first_render_target, "rerun_seconds": args.rerun_target}
+    failures = check_targets(result, targets)
+    record = {"timestamp": datetime.now().isoformat(timespec="seconds"), "benchmark": "startup", **environment_info(),
+              "repeat": args.repeat, "reruns": args.reruns, **{k: round(v, 4) if isinstance(v, float) else v for k, v in result.items()},
+              "targets": targets, "ok": not failures}
+    with open(args.results, "a", encoding="utf-8") as results_file:
+        results_file.write(json.dumps(record, ensure_ascii=False) + "\n")
+
+    for name, target in targets.items():
+        print(f"{name:22} {result[name]:>8.3f}s  (mục tiêu {target:.3f}s)")
+    print(f"{'rerun_max_seconds':22} {result['rerun_max_seconds']:>8.3f}s")
+    for failure in failures: print(f"KHÔNG ĐẠT: {failure}")
+    print(f"Kết quả đã ghi vào {args.results}")
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,74 @@
+"""
+Sinh bảng kê hóa đơn POS giả lập (cùng bố cục với bảng kê thật) để đo hiệu năng.
+
+Ví dụ:
+    python benchmarks/generate_bang_ke.py 100000 -o bench_data/bang_ke_100k.xlsx --chxd "Phủ Lý"
+
+Bố cục: 4 dòng đầu (tiêu đề), dữ liệu từ dòng 5, 17 cột A..Q giống bảng kê xuất từ POS.
+Khoảng 60% số dòng là "Người mua không lấy hóa đơn" (gộp thành dòng tổng hợp), còn lại là khách có mã/không có mã,
+có lẫn mặt hàng không phải nhiên liệu và vài ô số lượng dạng chuỗi.
+"""
+import argparse
+import os
+import random
+import sys
+from openpyxl import Workbook
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from upsse_core import load_static_data_snapshot, clean_string
+
+DEFAULT_DATA_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "Data.xlsx")
+DEFAULT_CHXD = "Phủ Lý"
+
+PRODUCTS = [("Xăng E5 RON 92-II", 20000), ("Xăng RON 95-III", 21000), ("Dầu DO 0,05S-II", 19000),
+            ("Dầu DO 0,001S-V", 19500), ("Dầu nhờn PV Oil", 55000)]
+CUSTOMER_CODES = ["KH001", "KH00002", "0123456789012", "  KH 003 "] # Mã dài hơn 9 ký tự được coi là không có mã
+NO_INVOICE_SHARE = 0.6
+
+def generate_bang_ke(path, n_rows, ky_hieu, seed=1, day_span=1, month="05-2025"):
+    """Ghi n_rows dòng bảng kê của cửa hàng có ký hiệu ky_hieu (không có số 1 ở đầu) ra path."""
+    rnd = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(["BẢNG KÊ HÓA ĐƠN BÁN HÀNG"])
+    ws.append([])
+    ws.append([f"Tháng {month}"])
+    ws.append(["STT", "Ký hiệu", "Số hóa đơn", "Ngày", "Mã khách", "Tên khách hàng", "Mã số thuế", "Địa chỉ", "Mặt hàng",
+               "ĐVT", "Số lượng", "Đơn giá", "Chiết khấu", "Tiền hàng", "Tiền thuế", "Ghi chú", "Trạng thái"])
+    for i in range(n_rows):
+        product, price = rnd.choice(PRODUCTS)
+        so_luong = round(rnd.uniform(1, 60), 3)
+        don_gia = price + rnd.choice([0, 100, -100])
+        tien_hang = round(so_luong * don_gia / 1.1)
+        ngay = f"{rnd.randint(1, day_span):02d}-{month} {rnd.randint(6, 21):02d}:{rnd.randint(0, 59):02d}"
+        if rnd.random() < NO_INVOICE_SHARE:
+            ma_kh, ten_kh, mst, dia_chi = None, "Người mua không lấy hóa đơn", None, None
+        else:
+            ma_kh = rnd.choice(CUSTOMER_CODES)
+            ten_kh, mst, dia_chi = f"Công ty  TNHH Vận tải {i % 97}", "0100109106", f"Số {i % 500} đường Lê Lợi, Nam Định"
+        ws.append([i + 1, ky_hieu, f"{i + 1:08d}", ngay, ma_kh, ten_kh, mst, dia_chi, product, "Lít",
+                   so_luong if rnd.random() > 0.01 else f"{so_luong}", don_gia, 0, tien_hang, round(tien_hang * 0.1), None, "Đã phát hành"])
+    wb.save(path)
+    return path
+
+def ky_hieu_for_chxd(static_data, chxd_name):
+    """Ký hiệu trên bảng kê của CHXD: F5 trong Data.xlsx bỏ số 1 đầu."""
+    ky_hieu = clean_string(static_data["chxd_detail_map"][clean_string(chxd_name)]["f5_val_full"])
+    return ky_hieu[1:] if ky_hieu.startswith('1') else ky_hieu
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sinh bảng kê hóa đơn POS giả lập để đo hiệu năng.")
+    parser.add_argument("rows", type=int, help="Số dòng dữ liệu")
+    parser.add_argument("-o", "--output", required=True, help="Đường dẫn file .xlsx cần ghi")
+    parser.add_argument("--chxd", default=DEFAULT_CHXD, help=f"Tên CHXD lấy ký hiệu hóa đơn (mặc định: {DEFAULT_CHXD})")
+    parser.add_argument("--data", default=DEFAULT_DATA_PATH, help="Đường dẫn Data.xlsx")
+    parser.add_argument("--days", type=int, default=1, help="Số ngày trải đều trong tháng (mặc định: 1)")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    ky_hieu = ky_hieu_for_chxd(load_static_data_snapshot(args.data), args.chxd)
+    generate_bang_ke(args.output, args.rows, ky_hieu, seed=args.seed, day_span=args.days)
+    print(f"Đã ghi {args.rows} dòng ({ky_hieu}) vào {args.output}")
+
+if __name__ == "__main__":
+    main()
@@ -1,11 +1,14 @@
 import streamlit as st
-import pandas as pd
-from openpyxl import load_workbook, Workbook
-from openpyxl.styles import NamedStyle, Alignment
-from datetime import datetime
 import io
+import logging
 import os
-import re # Import regex module
+from functools import partial
+from upsse_core import clean_string, load_static_data_snapshot, static_data_signature, convert_bkhd_to_upsse, BangKeError, PerfStats, log_perf_stats, perf_logger
+from upsse_cache import ResultCache, result_cache_key
+from upsse_multi import convert_bkhd_files, MERGE_MODE, ZIP_MODE
+from upsse_ledger import InvoiceLedger, convert_bkhd_delta
+from upsse_jobs import JobQueue, QUEUED, RUNNING, FAILED, CANCELLED
+from upsse_writer import OUTPUT_FORMATS, get_output_format
 
 # --- Cấu hình trang Streamlit ---
 st.set_page_config(layout="centered", page_title="Đồng bộ dữ liệu SSE")
@@ -13,113 +16,39 @@ st.set_page_config(layout="centered", page_title="Đồng bộ dữ liệu SSE")
 # Đường dẫn đến các file cần thiết (giả định cùng thư mục với script)
 LOGO_PATH = "Logo.png"
 DATA_FILE_PATH = "Data.xlsx" # Tên chính xác của file dữ liệu
-
-# Định nghĩa tiêu đề cho file UpSSE.xlsx (Di chuyển lên đây để luôn có sẵn)
-headers = ["Mã khách", "Tên khách hàng", "Ngày", "Số hóa đơn", "Ký hiệu", "Diễn giải", "Mã hàng", "Tên mặt hàng",
-           "Đvt", "Mã kho", "Mã vị trí", "Mã lô", "Số lượng", "Giá bán", "Tiền hàng", "Mã nt", "Tỷ giá", "Mã thuế",
-           "Tk nợ", "Tk doanh thu", "Tk giá vốn", "Tk thuế có", "Cục thuế", "Vụ việc", "Bộ phận", "Lsx", "Sản phẩm",
-           "Hợp đồng", "Phí", "Khế ước", "Nhân viên bán", "Tên KH(thuế)", "Địa chỉ (thuế)", "Mã số Thuế",
-           "Nhóm Hàng", "Ghi chú", "Tiền thuế"]
+ROW_ENGINE = os.environ.get("UPSSE_ENGINE", "loop") # Engine chuyển đổi: 'loop' hoặc 'pandas' (xem upsse_core.get_row_engine)
+PERF_LOG_PATH = os.environ.get("UPSSE_PERF_LOG") # File ghi số đo hiệu năng (JSON Lines); mặc định ghi ra stderr
+RESULT_CACHE_DIR = os.environ.get("UPSSE_CACHE_DIR") # Thư mục lưu kết quả đã xử lý trên đĩa; để trống thì chỉ giữ trong bộ nhớ
+RESULT_CACHE_MB = int(os.environ.get("UPSSE_CACHE_MB", "200")) # Tổng dung lượng tối đa của các kết quả được giữ lại
+LEDGER_PATH = os.environ.get("UPSSE_LEDGER_PATH", "upsse_ledger.sqlite3") # Sổ các hóa đơn đã chuyển (SQLite)
+JOB_WORKERS = int(os.environ.get("UPSSE_JOB_WORKERS", "2")) # Số lần xử lý chạy đồng thời trên toàn server, các lần khác chờ đến lượt
+JOB_TTL_SECONDS = int(os.environ.get("UPSSE_JOB_TTL", "3600")) # Thời gian giữ kết quả để tải xuống sau khi xử lý xong
+JOB_RESULT_MB = int(os.environ.get("UPSSE_JOB_RESULT_MB", "200")) # Tổng dung lượng tối đa của các kết quả chờ tải xuống
+JOB_POLL_SECONDS = 0.5 # Chu kỳ cập nhật thanh tiến độ
+
+# --- Ghi log hiệu năng (mỗi lần xử lý một dòng JSON) ---
+if not perf_logger.handlers: # Streamlit chạy lại script sau mỗi thao tác, chỉ gắn handler một lần
+    perf_handler = logging.FileHandler(PERF_LOG_PATH, encoding="utf-8") if PERF_LOG_PATH else logging.StreamHandler()
+    perf_handler.setFormatter(logging.Formatter("%(message)s"))
+    perf_logger.addHandler(perf_handler)
+    perf_logger.setLevel(logging.INFO)
+    perf_logger.propagate = False
 
 # --- Báo lỗi
 
-# --- Hàm trợ giúp chuyển đổi giá trị sang float an toàn ---
-def to_float(value):
-    """Chuyển đổi giá trị sang float, trả về 0.0 nếu không thể chuyển đổi."""
-    try:
-        if isinstance(value, str):
-            value = value.replace(",", "").strip()
-        return float(value)
-    except (ValueError, TypeError):
-        return 0.0
-
-# --- Hàm làm sạch chuỗi (loại bỏ mọi loại khoảng trắng và chuẩn hóa) ---
-def clean_string(s):
-    if s is None:
-        return ""
-    s = re.sub(r'\s+', ' ', str(s)).strip()
-    return s
-
 # --- Hàm đọc dữ liệu tĩnh và bảng tra cứu từ Data.xlsx ---
-@st.cache_data
+@st.cache_resource(show_spinner=False, max_entries=2)
+def load_static_data_cached(file_path, signature):
+    # signature đổi khi Data.xlsx được thay, nên lần chạy sau tự nạp lại
+    return load_static_data_snapshot(file_path)
+
 def get_static_data_from_excel(file_path):
     """
-    Đọc dữ liệu và xây dựng các bảng tra cứu từ Data.xlsx.
-    Sử dụng openpyxl để đọc dữ liệu. Kết quả được cache.
+    Đọc dữ liệu và xây dựng các bảng tra cứu từ Data.xlsx (xem upsse_core.load_static_data_snapshot).
+    Kết quả được giữ chung cho mọi phiên và tự nạp lại khi Data.xlsx thay đổi; mỗi lần chạy lại trang chỉ tốn một lần os.stat.
     """
     try:
-        wb = load_workbook(file_path, data_only=True)
-        ws = wb.active
-
-        listbox_data = []
-        chxd_detail_map = {}
-        store_specific_x_lookup = {}
-        
-        for row_idx in range(4, ws.max_row + 1):
-            row_data_values = [cell.value for cell in ws[row_idx]]
-
-            if len(row_data_values) < 18: continue
-
-            raw_chxd_name = row_data_values[10]
-            if raw_chxd_name and clean_string(raw_chxd_name):
-                chxd_name_str = clean_string(raw_chxd_name)
-                
-                if chxd_name_str and chxd_name_str not in listbox_data:
-                    listbox_data.append(chxd_name_str)
-
-                g5_val = row_data_values[15] if pd.notna(row_data_values[15]) else None
-                f5_val_full = clean_string(row_data_values[16]) if pd.notna(row_data_values[16]) else ''
-                h5_val = clean_string(row_data_values[17]).lower() if pd.notna(row_data_values[17]) else ''
-                
-                if f5_val_full:
-                    chxd_detail_map[chxd_name_str] = {
-                        'g5_val': g5_val, 'h5_val': h5_val,
-                        'f5_val_full': f5_val_full, 'b5_val': chxd_name_str
-                    }
-                
-                # Column mapping for store_specific_x_lookup
-                # These indices are based on the Data.xlsx structure for X lookup values
-                store_specific_x_lookup[chxd_name_str] = {
-                    "xăng e5 ron 92-ii": row_data_values[11], # Original column L
-                    "xăng ron 95-iii":   row_data_values[12], # Original column M
-                    "dầu do 0,05s-ii":   row_data_values[13], # Original column N
-                    "dầu do 0,001s-v":   row_data_values[14]  # Original column O
-                }
-        
-        lookup_table = {} # For "Mã hàng" lookup (I4:J6 in Data.xlsx)
-        for row in ws.iter_rows(min_row=4, max_row=7, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: lookup_table[clean_string(row[0]).lower()] = row[1]
-        
-        tmt_lookup_table = {} # For "Thuế bảo vệ môi trường" lookup (I10:J13 in Data.xlsx)
-        for row in ws.iter_rows(min_row=10, max_row=13, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: tmt_lookup_table[clean_string(row[0]).lower()] = to_float(row[1])
-        
-        s_lookup_table = {} # For "Tk nợ" lookup (I29:J31 in Data.xlsx)
-        for row in ws.iter_rows(min_row=29, max_row=31, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: s_lookup_table[clean_string(row[0]).lower()] = row[1]
-        
-        t_lookup_regular = {} # For "Tk doanh thu" lookup (I33:J35 in Data.xlsx)
-        for row in ws.iter_rows(min_row=33, max_row=35, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: t_lookup_regular[clean_string(row[0]).lower()] = row[1]
-        
-        t_lookup_tmt = {} # For "Tk doanh thu" for TMT (I48:J50 in Data.xlsx)
-        for row in ws.iter_rows(min_row=48, max_row=50, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: t_lookup_tmt[clean_string(row[0]).lower()] = row[1]
-
-        v_lookup_table = {} # For "Tk thuế có" lookup (I53:J55 in Data.xlsx)
-        for row in ws.iter_rows(min_row=53, max_row=55, min_col=9, max_col=10, values_only=True):
-            if row[0] and row[1]: v_lookup_table[clean_string(row[0]).lower()] = row[1]
-        
-        u_value = ws['J36'].value # Value from J36 in Data.xlsx
-        wb.close()
-        
-        return {
-            "listbox_data": listbox_data, "lookup_table": lookup_table,
-            "tmt_lookup_table": tmt_lookup_table, "s_lookup_table": s_lookup_table,
-            "t_lookup_regular": t_lookup_regular, "t_lookup_tmt": t_lookup_tmt,
-            "v_lookup_table": v_lookup_table, "u_value": u_value,
-            "chxd_detail_map": chxd_detail_map, "store_specific_x_lookup": store_specific_x_lookup
-        }
+        return load_static_data_cached(file_path, static_data_signature(file_path))
     except FileNotFoundError:
         st.error(f"Lỗi: Không tìm thấy file {file_path}. Vui lòng đảm bảo file tồn tại.")
         st.stop()
@@ -128,95 +57,138 @@ def get_static_data_from_excel(file_path):
         st.exception(e)
         st.stop()
 
-# --- Functions for adding TMT summary row (must be defined before add_summary_row_for_no_invoice) ---
-def add_tmt_summary_row(product_name_full, total_bvmt_amount, g5_val, s_lookup, t_lookup_tmt, v_lookup, u_val, h5_val, 
-                        representative_date, representative_symbol, total_quantity_for_tmt, tmt_unit_value_for_summary, b5_val, customer_name_for_summary_row, x_lookup_for_store):
-    new_tmt_row = [''] * len(headers)
-    new_tmt_row[0], new_tmt_row[1], new_tmt_row[2] = g5_val, customer_name_for_summary_row, representative_date
-    value_C, value_E = clean_string(representative_date), clean_string(representative_symbol)
-    suffix_d = {"Xăng E5 RON 92-II": "1", "Xăng RON 95-III": "2", "Dầu DO 0,05S-II": "3", "Dầu DO 0,001S-V": "4"}.get(product_name_full, "")
-    if b5_val == "Nguyễn Huệ": new_tmt_row[3] = f"HNBK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    elif b5_val == "Mai Linh": new_tmt_row[3] = f"MMBK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    else: new_tmt_row[3] = f"{value_E[-2:]}BK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    new_tmt_row[4] = representative_symbol
-    new_tmt_row[6], new_tmt_row[7], new_tmt_row[8] = "TMT", "Thuế bảo vệ môi trường", "Lít"
-    new_tmt_row[9], new_tmt_row[12] = g5_val, total_quantity_for_tmt
-    new_tmt_row[13] = tmt_unit_value_for_summary
-    new_tmt_row[14] = round(to_float(total_quantity_for_tmt) * to_float(tmt_unit_value_for_summary), 0) # Tiền hàng for TMT summary
-    new_tmt_row[17] = 10
-    new_tmt_row[18] = s_lookup.get(h5_val, '')
-    new_tmt_row[19] = t_lookup_tmt.get(h5_val, '')
-    new_tmt_row[20], new_tmt_row[21] = u_val, v_lookup.get(h5_val, '')
-    new_tmt_row[23] = x_lookup_for_store.get(product_name_full.lower(), '')
-    new_tmt_row[31] = "" # Tên KH(thuế) cho dòng TMT summary
-    new_tmt_row[36] = round(to_float(total_quantity_for_tmt) * to_float(tmt_unit_value_for_summary) * 0.1, 0)
-    for idx in [5,10,11,15,16,22,24,25,26,27,28,29,30,32,33,34,35]:
-        if idx != 23 and idx < len(new_tmt_row): new_tmt_row[idx] = ''
-    return new_tmt_row
-
-# --- Functions for adding summary row for no invoice ---
-def add_summary_row_for_no_invoice(data_for_summary_product, bkhd_source_ws, product_name, headers_list,
-                    g5_val, b5_val, s_lookup, t_lookup, v_lookup, x_lookup_for_store, u_val, h5_val, common_lookup_table):
-    new_row = [''] * len(headers_list)
-    new_row[0], new_row[1] = g5_val, f"Khách hàng mua {product_name} không lấy hóa đơn"
-    new_row[2] = data_for_summary_product[0][2] if data_for_summary_product else "" # Date (from first row)
-    new_row[4] = data_for_summary_product[0][4] if data_for_summary_product else "" # Symbol (from first row)
-    value_C, value_E = clean_string(new_row[2]), clean_string(new_row[4])
-    suffix_d = {"Xăng E5 RON 92-II": "1", "Xăng RON 95-III": "2", "Dầu DO 0,05S-II": "3", "Dầu DO 0,001S-V": "4"}.get(product_name, "")
-    if b5_val == "Nguyễn Huệ": new_row[3] = f"HNBK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    elif b5_val == "Mai Linh": new_row[3] = f"MMBK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    else: new_row[3] = f"{value_E[-2:]}BK{value_C[-2:]}.{value_C[5:7]}.{suffix_d}"
-    new_row[5] = f"Xuất bán lẻ theo hóa đơn số {new_row[3]}"
-    new_row[6], new_row[7], new_row[8], new_row[9] = common_lookup_table.get(clean_string(product_name).lower(), ''), product_name, "Lít", g5_val
-    new_row[10], new_row[11] = '', ''
-    total_M = sum(to_float(r[12]) for r in data_for_summary_product) # r[12] is 'Số lượng' from processed row (upsse_row[12])
-    new_row[12] = total_M
-    new_row[13] = max((to_float(r[13]) for r in data_for_summary_product), default=0.0) # r[13] is 'Giá bán' from processed row (upsse_row[13])
-
-    tien_hang_hd = sum(to_float(r[13]) for r in bkhd_source_ws.iter_rows(min_row=2, values_only=True) if clean_string(r[5]) == "Người mua không lấy hóa đơn" and clean_string(r[8]) == product_name)
-    price_per_liter = {"Xăng E5 RON 92-II": 1900, "Xăng RON 95-III": 2000, "Dầu DO 0,05S-II": 1000, "Dầu DO 0,001S-V": 1000}.get(product_name, 0)
-    new_row[14] = tien_hang_hd - round(total_M * price_per_liter, 0)
-
-    new_row[15], new_row[16], new_row[17] = '', '', 10
-    new_row[18], new_row[19] = s_lookup.get(h5_val, ''), t_lookup.get(h5_val, '')
-    new_row[20], new_row[21] = u_val, v_lookup.get(h5_val, '')
-    new_row[22] = ''
-    new_row[23] = x_lookup_for_store.get(clean_string(product_name).lower(), '')
-    for i in range(24, 31): new_row[i] = ''
-    new_row[31] = f"Khách mua {product_name} không lấy hóa đơn"
-    new_row[32], new_row[33], new_row[34], new_row[35] = "", "", '', ''
-    
-    TienthueHD_from_original_bkhd = sum(to_float(row_bkhd[14]) for row_bkhd in bkhd_source_ws.iter_rows(min_row=2, values_only=True) if clean_string(row_bkhd[5]) == "Người mua không lấy hóa đơn" and clean_string(row_bkhd[8]) == product_name)
-    new_row[36] = TienthueHD_from_original_bkhd - round(total_M * price_per_liter * 0.1, 0) 
-    return new_row
-
-
-def create_per_invoice_tmt_row(original_row_data, tmt_value, g5_val, s_lookup, t_lookup_tmt, v_lookup, u_val, h5_val):
-    tmt_row = list(original_row_data)
-    tmt_row[6], tmt_row[7], tmt_row[8] = "TMT", "Thuế bảo vệ môi trường", "Lít"
-    tmt_row[9] = g5_val
-    tmt_row[13] = tmt_value
-    tmt_row[14] = round(tmt_value * to_float(original_row_data[12]), 0) # Tiền hàng for TMT row
-    tmt_row[17] = 10
-    tmt_row[18] = s_lookup.get(h5_val, '')
-    tmt_row[19] = t_lookup_tmt.get(h5_val, '')
-    tmt_row[20], tmt_row[21] = u_val, v_lookup.get(h5_val, '')
-    tmt_row[31] = ""
-    tmt_row[36] = round(tmt_value * to_float(original_row_data[12]) * 0.1, 0)
-    for idx in [5, 10, 11, 15, 16, 22, 24, 25, 26, 27, 28, 29, 30, 32, 33, 34, 35]:
-        if idx < len(tmt_row): tmt_row[idx] = ''
-    return tmt_row
+# --- Bộ nhớ đệm kết quả, dùng chung cho mọi phiên ---
+@st.cache_resource
+def get_result_cache():
+    return ResultCache(max_bytes=RESULT_CACHE_MB << 20, cache_dir=RESULT_CACHE_DIR)
+
+@st.cache_resource
+def get_invoice_ledger():
+    return InvoiceLedger(LEDGER_PATH)
+
+@st.cache_resource
+def get_job_queue():
+    return JobQueue(max_workers=JOB_WORKERS, ttl_seconds=JOB_TTL_SECONDS, max_result_bytes=JOB_RESULT_MB << 20)
+
+@st.cache_resource(show_spinner=False)
+def load_logo(file_path):
+    """Nội dung Logo.png (None nếu không có), chỉ đọc từ đĩa một lần."""
+    if not os.path.exists(file_path): return None
+    with open(file_path, "rb") as f:
+        return f.read()
+
+# --- Các công việc xử lý (chạy nền trong hàng đợi, không gọi st.* bên trong) ---
+# Bảng kê được đọc dạng luồng trong transform (hoặc ledger_lookup), công đoạn ingest chỉ được tách ra sau khi đo
+STAGE_PROGRESS = {"cache_lookup": (0.0, "Đang tìm kết quả đã xử lý..."), "batch_lookup": (0.0, "Đang tìm file đã tạo từ bảng kê này..."), "ledger_lookup": (0.05, "Đang đọc bảng kê và lọc các hóa đơn đã chuyển..."),
+                  "transform": (0.1, "Đang đọc và chuyển đổi bảng kê..."),
+                  "summaries": (0.6, "Đang tạo dòng tổng hợp..."), "ledger_record": (0.95, "Đang ghi sổ hóa đơn đã chuyển..."),
+                  **{f"write_{name}": (0.65, f"Đang ghi file UpSSE{f.extension}...") for name, f in OUTPUT_FORMATS.items()}}
+
+def job_stats(job, chxd_name, file_name, file_bytes, **context):
+    return PerfStats(listener=lambda stage: job.update(*STAGE_PROGRESS[stage]), cancel_check=job.check_cancelled, chxd=chxd_name, file_name=file_name, file_size=len(file_bytes), engine=ROW_ENGINE, **context)
+
+def perf_table(stats):
+    return [{"Công đoạn": s["stage"], "Số dòng": s["rows"], "Thời gian (s)": s["seconds"], "RSS cuối công đoạn (MB)": s["rss_mb"], "Đỉnh RSS tăng thêm (MB)": s["peak_growth_mb"]} for s in stats.stages]
+
+def run_single_file_job(job, file_name, file_bytes, chxd_name, static_data, result_cache, output_format="xlsx"):
+    # Cùng bảng kê, cùng CHXD, cùng Data.xlsx và cùng định dạng thì trả lại kết quả đã tạo, không xử lý lại
+    writer = get_output_format(output_format)
+    stats = job_stats(job, chxd_name, file_name, file_bytes, output_format=output_format)
+    cache_key = result_cache_key(file_bytes, chxd_name, static_data["data_version"], output_format)
+    with stats.stage("cache_lookup"):
+        upsse_bytes = result_cache.get(cache_key)
+    stats.context["cache"] = "hit" if upsse_bytes is not None else "miss"
+    if upsse_bytes is None:
+        output = io.BytesIO()
+        try:
+            convert_bkhd_to_upsse(io.BytesIO(file_bytes), chxd_name, static_data, output, engine=ROW_ENGINE, stats=stats, output_format=output_format)
+        except BangKeError:
+            log_perf_stats(stats, status="Lỗi")
+            raise
+        upsse_bytes = output.getvalue()
+        result_cache.put(cache_key, upsse_bytes)
+    log_perf_stats(stats)
+    return {"level": "success", "message": f"Đã tạo file UpSSE{writer.extension} thành công!", "data": upsse_bytes, "file_name": f"UpSSE{writer.extension}", "mime": writer.mime,
+            "perf_table": perf_table(stats),
+            "perf_caption": f"Tổng thời gian: {stats.total_seconds()} s, kích thước file: {len(file_bytes) / 1024:.0f} KB, engine: {ROW_ENGINE}"
+                            + (", lấy lại kết quả đã xử lý trước đó" if stats.context["cache"] == "hit" else "")}
+
+def run_delta_job(job, file_name, file_bytes, chxd_name, static_data, ledger, output_format="xlsx"):
+    # Kết quả phụ thuộc vào sổ hóa đơn đã chuyển nên không dùng bộ nhớ đệm kết quả
+    writer = get_output_format(output_format)
+    stats = job_stats(job, chxd_name, file_name, file_bytes, mode="delta", output_format=output_format)
+    output = io.BytesIO()
+    try:
+        _, new_invoice_count, skipped_count = convert_bkhd_delta(io.BytesIO(file_bytes), chxd_name, static_data, output, ledger, engine=ROW_ENGINE, stats=stats, output_format=output_format)
+    except BangKeError:
+        log_perf_stats(stats, status="Lỗi")
+        raise
+    log_perf_stats(stats)
+    result = {"perf_table": perf_table(stats), "perf_caption": f"Tổng thời gian: {stats.total_seconds()} s, kích thước file: {len(file_bytes) / 1024:.0f} KB, engine: {ROW_ENGINE}"}
+    if not new_invoice_count:
+        return {**result, "level": "info", "message": f"Tất cả {skipped_count} dòng của bảng kê đã được chuyển trước đây, không có hóa đơn mới."}
+    if stats.context["batch"] == "reused": # Cùng bảng kê đã chuyển trước đây: cho tải lại đúng file đã tạo lúc đó
+        return {**result, "level": "warning", "message": f"Bảng kê này đã được chuyển lúc {stats.context['batch_created_at'].replace('T', ' ')}. Đây là file UpSSE{writer.extension} đã tạo lúc đó "
+                                                         f"({new_invoice_count} hóa đơn mới), chỉ nhập vào SSE nếu chưa nhập file này.",
+                "data": output.getvalue(), "file_name": f"UpSSE{writer.extension}", "mime": writer.mime}
+    return {**result, "level": "success", "message": f"Đã tạo file UpSSE{writer.extension} cho {new_invoice_count} hóa đơn mới (bỏ qua {skipped_count} dòng đã chuyển trước đây)!",
+            "data": output.getvalue(), "file_name": f"UpSSE{writer.extension}", "mime": writer.mime}
+
+def run_multi_file_job(job, files, chxd_name, static_data, output_mode, output_format="xlsx"):
+    writer = get_output_format(output_format)
+    job.update(0.0, f"Đang xử lý {len(files)} file bảng kê...")
+    results, upsse_bytes = convert_bkhd_files(files, chxd_name, static_data, mode=output_mode, engine=ROW_ENGINE, output_format=output_format, cancel_check=job.check_cancelled,
+                                              progress=lambda done, total, name: job.update(done / total, f"Đã xử lý {done}/{total} file ({name})"))
+    for r in results:
+        log_perf_stats(r["stats"], status=r["status"])
+    result = {"errors": [f"{r['name']}: {r['message']}" for r in results if r["status"] != "OK"],
+              "perf_table": [{"File": r["name"], "Trạng thái": r["status"], "Số dòng": r["rows"], "Thời gian (s)": r["stats"].total_seconds()} for r in results]}
+    if upsse_bytes is None:
+        return {**result, "level": "error", "message": "Không tạo được file kết quả, hãy sửa các bảng kê bị lỗi và thử lại."}
+    if output_mode == ZIP_MODE:
+        return {**result, "level": "success", "message": f"Đã tạo {sum(r['status'] == 'OK' for r in results)}/{len(results)} file UpSSE{writer.extension}!",
+                "data": upsse_bytes, "file_name": "UpSSE.zip", "mime": "application/zip"}
+    return {**result, "level": "success", "message": f"Đã gộp {len(results)} bảng kê thành file UpSSE{writer.extension}!",
+            "data": upsse_bytes, "file_name": f"UpSSE{writer.extension}", "mime": writer.mime}
+
+# --- Hiển thị tiến độ và kết quả của công việc ---
+def show_job(job):
+    if st.session_state.get("job_warning"): st.warning(st.session_state["job_warning"])
+    if job.status == QUEUED: st.info("Máy chủ đang xử lý bảng kê của cửa hàng khác, file của bạn sẽ được xử lý ngay khi đến lượt.")
+    if job.status in (QUEUED, RUNNING):
+        st.progress(job.progress, text=job.stage)
+        if st.button("Hủy xử lý", key='cancel_button'): job.cancel()
+    elif job.status == CANCELLED:
+        st.warning("Đã hủy xử lý.")
+    elif job.status == FAILED:
+        if isinstance(job.error, BangKeError): st.error(str(job.error))
+        else:
+            st.error(f"Lỗi trong quá trình xử lý file: {job.error}")
+            st.exception(job.error)
+    else:
+        result = job.result
+        for message in result.get("errors", []): st.error(message)
+        if result["level"] == "success": st.success(result["message"])
+        elif result["level"] == "info": st.info(result["message"])
+        elif result["level"] == "warning": st.warning(result["message"])
+        else: st.error(result["message"])
+        if result.get("data") is not None:
+            st.download_button(f"Tải xuống file {result['file_name']}", result["data"], result["file_name"], result["mime"])
+        with st.expander("Chi tiết hiệu năng"):
+            st.table(result["perf_table"])
+            if result.get("perf_caption"): st.caption(result["perf_caption"])
+
+def show_job_status():
+    job = get_job_queue().get(st.session_state.get("job_id"))
+    if job is None: return
+    if job.finished and st.session_state.get("job_polling"):
+        st.session_state["job_polling"] = False
+        st.rerun() # Chạy lại cả trang để ngừng cập nhật định kỳ
+    show_job(job)
 
 # --- Tải dữ liệu tĩnh ---
 static_data = get_static_data_from_excel(DATA_FILE_PATH)
 listbox_data = static_data["listbox_data"]
-lookup_table = static_data["lookup_table"]
-tmt_lookup_table = static_data["tmt_lookup_table"]
-s_lookup_table = static_data["s_lookup_table"]
-t_lookup_regular = static_data["t_lookup_regular"]
-t_lookup_tmt = static_data["t_lookup_tmt"]
-v_lookup_table = static_data["v_lookup_table"]
-u_value = static_data["u_value"]
 chxd_detail_map = static_data["chxd_detail_map"]
 store_specific_x_lookup = static_data["store_specific_x_lookup"]
 
@@ -224,8 +196,9 @@ store_specific_x_lookup = static_data["store_specific_x_lookup"]
 col1, col2 = st.columns([2, 5], vertical_alignment="center")
 
 with col1:
-    if os.path.exists(LOGO_PATH):
-        st.image(LOGO_PATH, width=180)
+    logo = load_logo(LOGO_PATH)
+    if logo is not None:
+        st.image(logo, width=180)
 with col2:
     st.markdown("""
     <div style="text-align: center;">
@@ -249,151 +222,43 @@ st.markdown("""
 <br>
 """, unsafe_allow_html=True)
 
-selected_value = st.selectbox("Chọn CHXD:", options=[""] + listbox_data, key='selected_chxd')
-uploaded_file = st.file_uploader("Tải lên file bảng kê hóa đơn (.xlsx)", type=["xlsx"])
-
-# --- Footer với thông tin tác giả ---
-st.markdown("---") # Thêm đường kẻ ngang để phân tách
-st.info("Nếu gặp khó khăn khi sử dụng công cụ, hãy liên hệ Nguyễn Trọng Hoàn - 0902069469")
-
-# --- Xử lý chính ---
-if st.button("Xử lý", key='process_button'):
-    if not selected_value: st.warning("Vui lòng chọn một giá trị từ danh sách CHXD.")
-    elif uploaded_file is None: st.warning("Vui lòng tải lên file bảng kê hóa đơn.")
-    else:
-        try:
+# --- Chọn CHXD, tải bảng kê và bấm "Xử lý" ---
+# Chạy trong fragment: thao tác trên các ô này chỉ chạy lại phần này, không chạy lại tiêu đề, logo và phần dữ liệu tĩnh
+@st.fragment
+def input_panel():
+    selected_value = st.selectbox("Chọn CHXD:", options=[""] + listbox_data, key='selected_chxd')
+    uploaded_files = st.file_uploader("Tải lên file bảng kê hóa đơn (.xlsx, có thể chọn nhiều file)", type=["xlsx"], accept_multiple_files=True)
+    output_modes = {"Gộp thành một file UpSSE": MERGE_MODE, "Mỗi bảng kê một file UpSSE, nén thành .zip": ZIP_MODE}
+    output_mode = output_modes[st.radio("Kết quả:", list(output_modes), horizontal=True)] if len(uploaded_files or []) > 1 else None
+    output_formats = {"UpSSE.xlsx (nhập vào SSE)": "xlsx", "CSV": "csv", "TSV": "tsv", "Parquet (phân tích dữ liệu)": "parquet"}
+    output_format = output_formats[st.radio("Định dạng file:", list(output_formats), horizontal=True, help="SSE chỉ nhập được file .xlsx; CSV, TSV và Parquet dùng cho đối chiếu, phân tích số liệu.")]
+    only_new_invoices = len(uploaded_files or []) <= 1 and st.checkbox("Chỉ chuyển các hóa đơn chưa chuyển trước đây (bảng kê lũy kế trong tháng)", key='only_new_invoices')
+
+    if st.button("Xử lý", key='process_button'):
+        if not selected_value: st.warning("Vui lòng chọn một giá trị từ danh sách CHXD.")
+        elif not uploaded_files: st.warning("Vui lòng tải lên file bảng kê hóa đơn.")
+        else:
             selected_value_normalized = clean_string(selected_value)
-            if selected_value_normalized not in chxd_detail_map:
-                st.error(f"Không tìm thấy thông tin chi tiết cho CHXD: '{selected_value_normalized}'")
-                st.stop()
-            
-            chxd_details = chxd_detail_map[selected_value_normalized]
-            g5_value, h5_value, f5_value_full, b5_value = chxd_details['g5_val'], chxd_details['h5_val'], chxd_details['f5_val_full'], chxd_details['b5_val']
-            x_lookup_for_store = store_specific_x_lookup.get(selected_value_normalized, {})
-            if not x_lookup_for_store:
-                st.warning(f"Không tìm thấy mã Vụ việc cho cửa hàng '{selected_value_normalized}' trong Data.xlsx.")
-
-            bkhd_wb = load_workbook(uploaded_file)
-            bkhd_ws = bkhd_wb.active
-
-            long_cells = [f"H{r_idx+1}" for r_idx, cell in enumerate(bkhd_ws['H']) if cell.value and len(str(cell.value)) > 128]
-            if long_cells:
-                st.error("Địa chỉ trên ô " + ', '.join(long_cells) + " quá dài, hãy điều chỉnh và thử lại.")
-                st.stop()
-
-            all_rows_from_bkhd = list(bkhd_ws.iter_rows(values_only=True))
-            temp_bkhd_data = all_rows_from_bkhd[4:] if len(all_rows_from_bkhd) >= 4 else []
-            
-            vi_tri_cu_idx = [0, 1, 2, 3, 4, 5, 7, 6, 8, 10, 11, 13, 14, 16] 
-            
-            intermediate_data = []
-            for row in temp_bkhd_data:
-                if len(row) <= max(vi_tri_cu_idx): continue
-                new_row = [row[i] for i in vi_tri_cu_idx]
-                if new_row[3]:
-                    try: new_row[3] = datetime.strptime(str(new_row[3])[:10], '%d-%m-%Y').strftime('%Y-%m-%d')
-                    except ValueError: pass
-                ma_kh = new_row[4]
-                new_row.append("No" if ma_kh is None or len(clean_string(ma_kh)) > 9 else "Yes")
-                intermediate_data.append(new_row)
-
-            if not intermediate_data:
-                st.error("Không có dữ liệu hợp lệ trong file bảng kê sau khi xử lý.")
-                st.stop()
+            missing_vu_viec = selected_value_normalized in chxd_detail_map and not store_specific_x_lookup.get(selected_value_normalized, {})
 
-            b2_bkhd = clean_string(intermediate_data[0][1])
-            f5_norm = clean_string(f5_value_full)
-            if f5_norm.startswith('1'): f5_norm = f5_norm[1:]
-            if f5_norm != b2_bkhd:
-                st.error("Bảng kê hóa đơn không phải của cửa hàng bạn chọn.")
-                st.stop()
+            files = [(f.name, f.getvalue()) for f in uploaded_files] # Đọc hết nội dung ngay, công việc chạy sau khi trang đã chạy lại
+            if len(files) > 1: job_func = partial(run_multi_file_job, files=files, chxd_name=selected_value_normalized, static_data=static_data, output_mode=output_mode, output_format=output_format)
+            elif only_new_invoices: job_func = partial(run_delta_job, file_name=files[0][0], file_bytes=files[0][1], chxd_name=selected_value_normalized, static_data=static_data, ledger=get_invoice_ledger(), output_format=output_format)
+            else: job_func = partial(run_single_file_job, file_name=files[0][0], file_bytes=files[0][1], chxd_name=selected_value_normalized, static_data=static_data, result_cache=get_result_cache(), output_format=output_format)
 
-            final_rows, all_tmt_rows = [[''] * len(headers) for _ in range(4)] + [headers], []
-            no_invoice_rows = {p: [] for p in ["Xăng E5 RON 92-II", "Xăng RON 95-III", "Dầu DO 0,05S-II", "Dầu DO 0,001S-V"]}
+            job_queue = get_job_queue()
+            previous_job = job_queue.get(st.session_state.get("job_id"))
+            if previous_job is not None and not previous_job.finished: previous_job.cancel() # Mỗi phiên chỉ chạy một lần xử lý
+            st.session_state["job_id"] = job_queue.submit(selected_value_normalized, job_func).id
+            st.session_state["job_polling"] = True
+            st.session_state["job_warning"] = f"Không tìm thấy mã Vụ việc cho cửa hàng '{selected_value_normalized}' trong Data.xlsx." if missing_vu_viec else None
+            st.rerun() # Chạy lại cả trang để phần tiến độ bên dưới bắt đầu cập nhật
 
-            for row in intermediate_data:
-                upsse_row = [''] * len(headers)
-                upsse_row[0] = clean_string(row[4]) if row[-1] == 'Yes' and row[4] and clean_string(row[4]) else g5_value
-                upsse_row[1], upsse_row[2] = clean_string(row[5]), row[3]
-                b_orig, c_orig = clean_string(row[1]), clean_string(row[2])
-                if b5_value == "Nguyễn Huệ": upsse_row[3] = f"HN{c_orig[-6:]}"
-                elif b5_value == "Mai Linh": upsse_row[3] = f"MM{c_orig[-6:]}"
-                else: upsse_row[3] = f"{b_orig[-2:]}{c_orig[-6:]}"
-                upsse_row[4] = f"1{b_orig}" if b_orig else ''
-                upsse_row[5] = f"Xuất bán lẻ theo hóa đơn số {upsse_row[3]}"
-                product_name = clean_string(row[8])
-                upsse_row[6], upsse_row[7] = lookup_table.get(product_name.lower(), ''), product_name
-                upsse_row[8], upsse_row[9] = "Lít", g5_value
-                upsse_row[10], upsse_row[11] = '', ''
-                upsse_row[12] = to_float(row[9])
-                tmt_value = tmt_lookup_table.get(product_name.lower(), 0.0)
-                upsse_row[13] = round(to_float(row[10]) / 1.1 - tmt_value, 2)
-                upsse_row[14] = to_float(row[11]) - round(tmt_value * upsse_row[12])
-                upsse_row[15], upsse_row[16], upsse_row[17] = '', '', 10
-                upsse_row[18] = s_lookup_table.get(h5_value, '')
-                upsse_row[19] = t_lookup_regular.get(h5_value, '')
-                upsse_row[20], upsse_row[21] = u_value, v_lookup_table.get(h5_value, '')
-                upsse_row[22] = ''
-                upsse_row[23] = x_lookup_for_store.get(product_name.lower(), '')
-                for i in range(24, 31): upsse_row[i] = ''
-                upsse_row[31] = upsse_row[1]
-                upsse_row[32], upsse_row[33] = row[6], row[7]
-                upsse_row[34], upsse_row[35] = '', ''
-                upsse_row[36] = to_float(row[12]) - round(upsse_row[12] * tmt_value * 0.1)
+input_panel()
 
-                if upsse_row[1] == "Người mua không lấy hóa đơn" and product_name in no_invoice_rows:
-                    no_invoice_rows[product_name].append(upsse_row)
-                else:
-                    final_rows.append(upsse_row)
-                    if tmt_value > 0 and upsse_row[12] > 0:
-                        all_tmt_rows.append(create_per_invoice_tmt_row(upsse_row, tmt_value, g5_value, s_lookup_table, t_lookup_tmt, v_lookup_table, u_value, h5_value))
-
-            for product_name, rows in no_invoice_rows.items():
-                if rows:
-                    summary_row = add_summary_row_for_no_invoice(rows, bkhd_ws, product_name, headers, g5_value, b5_value, s_lookup_table, t_lookup_regular, v_lookup_table, x_lookup_for_store, u_value, h5_value, lookup_table)
-                    final_rows.append(summary_row)
-                    
-                    tmt_unit = tmt_lookup_table.get(product_name.lower(), 0)
-                    total_qty = sum(to_float(r[12]) for r in rows)
-                    customer_name_for_summary_row = summary_row[1]
-                    
-                    all_tmt_rows.append(add_tmt_summary_row(product_name, 0, g5_value, s_lookup_table, t_lookup_tmt, v_lookup_table, u_value, h5_value, summary_row[2], summary_row[4], total_qty, tmt_unit, b5_value, customer_name_for_summary_row, x_lookup_for_store))
-
-            final_rows.extend(all_tmt_rows)
-
-            up_sse_wb_final = Workbook()
-            up_sse_ws_final = up_sse_wb_final.active
-            for row_data in final_rows: up_sse_ws_final.append(row_data)
-
-            text_style, date_style = NamedStyle(name="text_style", number_format='@'), NamedStyle(name="date_style", number_format='DD/MM/YYYY')
-            exclude_cols = {3, 13, 14, 15, 18, 19, 20, 21, 22, 37}
-            
-            for r in range(1, up_sse_ws_final.max_row + 1):
-                for c in range(1, up_sse_ws_final.max_column + 1):
-                    cell = up_sse_ws_final.cell(row=r, column=c)
-                    if not cell.value or clean_string(cell.value) == "None": continue
-                    if c == 3:
-                        try:
-                            cell.value = datetime.strptime(clean_string(cell.value), '%Y-%m-%d').date()
-                            cell.style = date_style
-                        except (ValueError, TypeError):
-                            pass
-                    elif c not in exclude_cols:
-                        cell.style = text_style
-            
-            for r in range(1, up_sse_ws_final.max_row + 1):
-                for c in range(18, 23):
-                    up_sse_ws_final.cell(row=r, column=c).number_format = '@'
-
-            up_sse_ws_final.column_dimensions['B'].width = 35
-            up_sse_ws_final.column_dimensions['C'].width = 12
-            up_sse_ws_final.column_dimensions['D'].width = 12
-
-            output = io.BytesIO()
-            up_sse_wb_final.save(output)
-            st.success("Đã tạo file UpSSE.xlsx thành công!")
-            st.download_button("Tải xuống file UpSSE.xlsx", output.getvalue(), "UpSSE.xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet")
+# --- Footer với thông tin tác giả ---
+st.markdown("---") # Thêm đường kẻ ngang để phân tách
+st.info("Nếu gặp khó khăn khi sử dụng công cụ, hãy liên hệ Nguyễn Trọng Hoàn - 0902069469")
 
-        except Exception as e:
-            st.error(f"Lỗi trong quá trình xử lý file: {e}")
-            st.exception(e)
+if st.session_state.get("job_id"):
+    st.fragment(show_job_status, run_every=JOB_POLL_SECONDS if st.session_state.get("job_polling") else None)()
@@ -0,0 +1,23 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT_DIR)
+sys.path.insert(0, os.path.join(ROOT_DIR, "benchmarks")) # generate_bang_ke: bảng kê giả lập cho các test
+
+import pytest
+from upsse_core import load_static_data_snapshot
+from generate_bang_ke import generate_bang_ke, ky_hieu_for_chxd
+
+DATA_PATH = os.path.join(ROOT_DIR, "Data.xlsx")
+
+@pytest.fixture(scope="session")
+def static_data():
+    return load_static_data_snapshot(DATA_PATH)
+
+@pytest.fixture
+def make_bang_ke(tmp_path, static_data):
+    """make_bang_ke(chxd_name, n_rows, **kwargs): đường dẫn bảng kê giả lập của CHXD (xem generate_bang_ke)."""
+    def make(chxd_name, n_rows, name="bang_ke.xlsx", **kwargs):
+        return generate_bang_ke(str(tmp_path / name), n_rows, ky_hieu_for_chxd(static_data, chxd_name), **kwargs)
+    return make
@@ -0,0 +1,16 @@
+import os
+from upsse_cache import ResultCache, CACHE_FILE_SUFFIX
+
+# Kết quả trên đĩa dùng lại được sau khi tạo lại bộ nhớ đệm, file bị bỏ theo LRU được xóa khỏi đĩa
+def test_disk_cache_roundtrip_and_eviction(tmp_path):
+    cache = ResultCache(max_bytes=250, cache_dir=str(tmp_path))
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert sorted(os.listdir(tmp_path)) == [f"a{CACHE_FILE_SUFFIX}", f"b{CACHE_FILE_SUFFIX}"]
+
+    reloaded = ResultCache(max_bytes=250, cache_dir=str(tmp_path))
+    assert reloaded.get("a") == b"a" * 100 # Đọc từ đĩa, "a" trở thành dùng gần nhất
+    reloaded.put("c", b"c" * 100)
+    assert reloaded.get("b") is None
+    assert sorted(os.listdir(tmp_path)) == [f"a{CACHE_FILE_SUFFIX}", f"c{CACHE_FILE_SUFFIX}"]
+    assert (reloaded.hits, reloaded.misses) == (1, 1)
@@ -0,0 +1,35 @@
+import pytest
+from upsse_core import ChxdRules, iter_bkhd_rows, build_invoice_rows, build_no_invoice_summary_rows
+
+pd = pytest.importorskip("pandas")
+from upsse_vectorized import build_invoice_rows_vectorized
+
+def cells_with_types(rows):
+    return [[(type(value), value) for value in row.to_cells()] for row in rows]
+
+# Bảng kê giả lập có đủ 4 loại nhiên liệu, dầu nhờn, ô số lượng dạng chuỗi và nhiều ngày;
+# Phủ Lý lấy tiền tố số hóa đơn theo ký hiệu, Nguyễn Huệ theo tiền tố HN, tiền tố MM (Mai Linh) được gán trực tiếp
+@pytest.mark.parametrize("chxd_name, so_hd_prefix", [("Phủ Lý", None), ("Nguyễn Huệ", None), ("Phủ Lý", "MM")])
+def test_loop_and_pandas_engines_match(make_bang_ke, static_data, chxd_name, so_hd_prefix):
+    rules = ChxdRules(static_data, chxd_name)
+    if so_hd_prefix is not None: rules.so_hd_prefix = so_hd_prefix
+    bkhd_rows = list(iter_bkhd_rows(make_bang_ke(chxd_name, 2000, seed=7, day_span=3), rules.f5_full))
+    assert any(isinstance(row[9], str) for row in bkhd_rows) # Có ô số lượng dạng chuỗi (cột K của bảng kê)
+
+    loop_rows, loop_tmt_rows, loop_totals = build_invoice_rows(bkhd_rows, rules)
+    pandas_rows, pandas_tmt_rows, pandas_totals = build_invoice_rows_vectorized(bkhd_rows, rules)
+    assert cells_with_types(pandas_rows) == cells_with_types(loop_rows)
+    assert cells_with_types(pandas_tmt_rows) == cells_with_types(loop_tmt_rows)
+    assert pandas_totals == loop_totals
+
+    loop_summary = build_no_invoice_summary_rows(loop_totals, rules)
+    pandas_summary = build_no_invoice_summary_rows(pandas_totals, rules)
+    for loop_part, pandas_part in zip(loop_summary, pandas_summary):
+        assert cells_with_types(pandas_part) == cells_with_types(loop_part)
+    assert {row.ten_mat_hang for row in loop_rows} >= {"Xăng E5 RON 92-II", "Xăng RON 95-III", "Dầu DO 0,05S-II", "Dầu DO 0,001S-V"}
+    assert len(loop_summary[0]) == 4 and len(loop_summary[1]) == 4
+
+    loop_by_day = build_invoice_rows(bkhd_rows, rules, by_day=True)
+    pandas_by_day = build_invoice_rows_vectorized(bkhd_rows, rules, by_day=True)
+    assert cells_with_types(pandas_by_day[0]) == cells_with_types(loop_rows)
+    assert list(pandas_by_day[2].items()) == list(loop_by_day[2].items()) and len(loop_by_day[2]) == 3
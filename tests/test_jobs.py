@@ -0,0 +1,47 @@
+import io
+import pytest
+from upsse_core import convert_bkhd_to_upsse, PerfStats
+from upsse_jobs import JobQueue, DONE, CANCELLED
+
+def finished_job(queue, size):
+    job = queue.submit("job", lambda job: {"data": b"x" * size})
+    job._future.result()
+    return job
+
+# Kết quả giữ lại bị giới hạn theo tổng dung lượng, bỏ công việc ít được xem lại nhất trước
+def test_finished_results_are_bounded_by_bytes():
+    queue = JobQueue(max_workers=1, ttl_seconds=3600, max_result_bytes=250)
+    first, second = finished_job(queue, 100), finished_job(queue, 100)
+    assert queue.get(first.id) is first # first vừa được xem lại nên second bị bỏ trước
+    third = finished_job(queue, 100)
+    assert queue.get(second.id) is None
+    assert queue.get(first.id) is first and queue.get(third.id) is third
+
+# Kết quả mới nhất vẫn được giữ dù một mình đã vượt giới hạn
+def test_latest_result_is_kept_when_over_limit():
+    queue = JobQueue(max_workers=1, ttl_seconds=3600, max_result_bytes=50)
+    first, second = finished_job(queue, 100), finished_job(queue, 100)
+    assert queue.get(first.id) is None
+    assert queue.get(second.id) is second and second.status == DONE
+
+# cancel_check được gọi ngay trong lúc đọc bảng kê và trong vòng lặp ghi file, không chỉ ở đầu công đoạn
+@pytest.mark.parametrize("output_format", ["xlsx", "csv", "parquet"])
+def test_cancel_check_runs_inside_read_and_write(make_bang_ke, static_data, output_format):
+    if output_format == "parquet": pytest.importorskip("pyarrow")
+    current_stage, checked_stages = [], set()
+    stats = PerfStats(listener=current_stage.append, cancel_check=lambda: checked_stages.add(current_stage[-1]))
+    convert_bkhd_to_upsse(make_bang_ke("Phủ Lý", 2500), "Phủ Lý", static_data, io.BytesIO(), stats=stats, output_format=output_format)
+    assert checked_stages == {"transform", f"write_{output_format}"}
+
+# Bấm hủy khi đang ghi file: công việc dừng giữa lúc ghi thay vì chạy đến hết
+def test_job_cancelled_while_writing_stops(make_bang_ke, static_data):
+    path = make_bang_ke("Phủ Lý", 2500)
+    queue = JobQueue(max_workers=1)
+
+    def run(job):
+        stats = PerfStats(listener=lambda stage: job.cancel() if stage == "write_xlsx" else None, cancel_check=job.check_cancelled)
+        return {"data": None, "rows": convert_bkhd_to_upsse(path, "Phủ Lý", static_data, io.BytesIO(), stats=stats)}
+
+    job = queue.submit("job", run)
+    job._future.result()
+    assert job.status == CANCELLED and job.result is None
@@ -0,0 +1,87 @@
+import io
+import threading
+import time
+import pytest
+from openpyxl import load_workbook
+from upsse_core import iter_bkhd_rows, get_chxd_rules, build_invoice_rows, PerfStats
+from upsse_ledger import InvoiceLedger, convert_bkhd_delta
+
+class SlowLedger(InvoiceLedger):
+    """Sổ tra chậm để hai lần chuyển chắc chắn chồng lên nhau giữa lúc tra sổ và lúc ghi sổ."""
+    def seen_invoices(self, keys):
+        seen = super().seen_invoices(keys)
+        time.sleep(0.2)
+        return seen
+
+# Hai lần chuyển cùng CHXD chạy đồng thời, bảng kê lũy kế ngắn và dài có chung 200 hóa đơn: mỗi hóa đơn chỉ được nhận là mới một lần
+def test_concurrent_deltas_import_each_invoice_once(make_bang_ke, static_data, tmp_path):
+    paths = [make_bang_ke("Phủ Lý", n_rows, name=f"luy_ke_{n_rows}.xlsx", seed=3, day_span=2) for n_rows in (200, 300)]
+    ledger = SlowLedger(str(tmp_path / "ledger.sqlite3"))
+    barrier, results, errors = threading.Barrier(2), [], []
+
+    def run(path):
+        barrier.wait()
+        try: results.append(convert_bkhd_delta(path, "Phủ Lý", static_data, io.BytesIO(), ledger))
+        except Exception as e: errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(path,)) for path in paths]
+    for thread in threads: thread.start()
+    for thread in threads: thread.join()
+    ledger.close()
+
+    assert not errors
+    assert sum(new_invoice_count for _, new_invoice_count, _ in results) == 300
+    assert sum(skipped for _, _, skipped in results) == 200
+
+def summary_rows(output):
+    """Các dòng tổng hợp "không lấy hóa đơn" (không gồm TMT tổng hợp) của file UpSSE.xlsx: (ngày, số hóa đơn, mặt hàng, số lượng)."""
+    rows = load_workbook(io.BytesIO(output.getvalue()), read_only=True).active.iter_rows(min_row=6, values_only=True)
+    return [(row[2], row[3], row[7], row[12]) for row in rows if str(row[1]).startswith("Khách hàng mua") and row[6] != "TMT"]
+
+# Bảng kê lũy kế hai ngày, lần sau dài hơn lần trước: lần sau chỉ xuất phần tăng thêm dưới số hóa đơn tổng hợp mới,
+# cộng các lần xuất bằng tổng cả ngày
+def test_growing_bang_ke_exports_only_summary_increments(make_bang_ke, static_data, tmp_path):
+    first_path = make_bang_ke("Phủ Lý", 200, name="luy_ke_1.xlsx", seed=4, day_span=2)
+    second_path = make_bang_ke("Phủ Lý", 300, name="luy_ke_2.xlsx", seed=4, day_span=2) # 200 dòng đầu trùng với first_path
+    ledger = InvoiceLedger(str(tmp_path / "ledger.sqlite3"))
+    first_output, second_output = io.BytesIO(), io.BytesIO()
+    convert_bkhd_delta(first_path, "Phủ Lý", static_data, first_output, ledger)
+    _, new_invoice_count, skipped = convert_bkhd_delta(second_path, "Phủ Lý", static_data, second_output, ledger)
+    ledger.close()
+    assert (new_invoice_count, skipped) == (100, 200)
+
+    first_summary, second_summary = summary_rows(first_output), summary_rows(second_output)
+    assert len(first_summary) == len(second_summary) == 8 # 2 ngày x 4 mặt hàng
+    assert all(so_hd.endswith("-2") for _, so_hd, _, _ in second_summary)
+    assert {so_hd[:-2] for _, so_hd, _, _ in second_summary} == {so_hd for _, so_hd, _, _ in first_summary}
+
+    rules = get_chxd_rules(static_data, "Phủ Lý")
+    _, _, day_totals = build_invoice_rows(iter_bkhd_rows(second_path, rules.f5_full), rules, by_day=True)
+    expected = {(str(ngay)[:10], p): t["so_luong"] for (ngay, _), totals in day_totals.items() for p, t in totals.items() if t["so_dong"]}
+    exported = {}
+    for ngay, _, product_name, so_luong in first_summary + second_summary:
+        exported[(str(ngay)[:10], product_name)] = exported.get((str(ngay)[:10], product_name), 0.0) + so_luong
+    assert exported.keys() == expected.keys()
+    for key, so_luong in expected.items():
+        assert exported[key] == pytest.approx(so_luong)
+
+# Chưa tải được file của lần chuyển trước (trang bị tải lại, công việc hết hạn): đưa lại đúng bảng kê đó thì nhận lại đúng file cũ,
+# kể cả sau khi khởi động lại server; hóa đơn không bị ghi vào sổ lần nữa
+def test_reupload_after_lost_download_returns_same_file(make_bang_ke, static_data, tmp_path):
+    path = make_bang_ke("Phủ Lý", 200, seed=6)
+    db_path = str(tmp_path / "ledger.sqlite3")
+    ledger = InvoiceLedger(db_path)
+    lost_output = io.BytesIO()
+    first_result = convert_bkhd_delta(path, "Phủ Lý", static_data, lost_output, ledger)
+    assert first_result[1] == 200
+    ledger.close()
+
+    ledger = InvoiceLedger(db_path)
+    for _ in range(2):
+        stats, output = PerfStats(), io.BytesIO()
+        assert convert_bkhd_delta(path, "Phủ Lý", static_data, output, ledger, stats=stats) == first_result
+        assert output.getvalue() == lost_output.getvalue()
+        assert stats.context["batch"] == "reused" and stats.context["batch_created_at"]
+    assert ledger._conn.execute("SELECT count(*) FROM invoices").fetchone()[0] == 200
+    assert ledger._conn.execute("SELECT max(lan_xuat) FROM no_invoice_totals").fetchone()[0] == 1
+    ledger.close()
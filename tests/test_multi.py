@@ -0,0 +1,45 @@
+import io
+import pytest
+from openpyxl import load_workbook
+from upsse_writer import get_output_format
+from upsse_core import headers, iter_bkhd_rows, get_chxd_rules, build_invoice_rows, build_no_invoice_summary_rows, read_and_transform_bkhd, build_merged_upsse_rows, convert_bkhd_to_upsse
+
+def summary_cells(rows):
+    """Các dòng tổng hợp "không lấy hóa đơn" và TMT tổng hợp (số hóa đơn dạng ..BKdd.mm.n).
+    Số thực được làm tròn vì cộng theo từng bảng kê rồi gộp lệch thứ tự cộng so với cộng một lượt."""
+    cells_list = ([round(c, 6) if isinstance(c, float) else c for c in row.to_cells()] for row in rows if "BK" in str(row.so_hoa_don))
+    return sorted(cells_list, key=lambda cells: (cells[2], cells[3], cells[6]))
+
+def sheet_values(output):
+    return list(load_workbook(io.BytesIO(output.getvalue()), read_only=True).active.iter_rows(values_only=True))
+
+# Gộp bảng kê: dòng tổng hợp phải theo ngày, ký hiệu của từng dòng, như khi cộng dồn riêng từng ngày của cả các bảng kê
+@pytest.mark.parametrize("n_files", [1, 2])
+def test_merged_summaries_are_per_day(make_bang_ke, static_data, n_files):
+    rules = get_chxd_rules(static_data, "Phủ Lý")
+    paths = [make_bang_ke("Phủ Lý", 600, name=f"bang_ke_{i}.xlsx", seed=i + 1, day_span=3) for i in range(n_files)]
+    parts = [read_and_transform_bkhd(path, "Phủ Lý", static_data, by_day=True) for path in paths]
+    merged_rows = build_merged_upsse_rows(parts, "Phủ Lý", static_data)
+
+    rows_by_day = {}
+    for path in paths:
+        for row in iter_bkhd_rows(path, rules.f5_full):
+            rows_by_day.setdefault(row[3], []).append(row)
+    assert len(rows_by_day) == 3
+    expected = []
+    for day in sorted(rows_by_day):
+        summary_rows, tmt_summary_rows = build_no_invoice_summary_rows(build_invoice_rows(rows_by_day[day], rules)[2], rules)
+        expected.extend(summary_rows + tmt_summary_rows)
+    assert summary_cells(merged_rows) == summary_cells(expected)
+    for path, (invoice_rows, _, _) in zip(paths, parts): # Dòng hóa đơn giữ đúng thứ tự trên bảng kê
+        assert [row.to_cells() for row in invoice_rows] == [row.to_cells() for row in build_invoice_rows(iter_bkhd_rows(path, rules.f5_full), rules)[0]]
+    assert len(merged_rows) == sum(len(p[0]) + len(p[1]) for p in parts) + len(expected)
+
+# Gộp một bảng kê một ngày cho đúng file (cả thứ tự dòng) như chuyển riêng bảng kê đó
+def test_merging_one_single_day_file_matches_single_file_output(make_bang_ke, static_data):
+    path = make_bang_ke("Phủ Lý", 600, seed=5)
+    single_output, merged_output = io.BytesIO(), io.BytesIO()
+    convert_bkhd_to_upsse(path, "Phủ Lý", static_data, single_output)
+    merged_rows = build_merged_upsse_rows([read_and_transform_bkhd(path, "Phủ Lý", static_data, by_day=True)], "Phủ Lý", static_data)
+    get_output_format("xlsx").write(headers, merged_rows, merged_output)
+    assert sheet_values(merged_output) == sheet_values(single_output)
@@ -0,0 +1,80 @@
+import csv
+import io
+import re
+import zipfile
+import pytest
+from openpyxl import load_workbook
+from upsse_core import headers, convert_bkhd_to_upsse, iter_bkhd_rows, get_chxd_rules, build_invoice_rows
+from upsse_writer import BLANK_LEADING_ROWS, DATE_COL, NUMBER_COLS, FORCED_TEXT_COLS, EXCLUDE_TEXT_COLS, get_output_format
+
+# SSE đọc UpSSE.xlsx theo thẻ <dimension> và định dạng ô; writer dựa vào chi tiết riêng của openpyxl nên cần kiểm tra lại khi nâng openpyxl
+def test_xlsx_dimension_and_number_formats(make_bang_ke, static_data):
+    output = io.BytesIO()
+    n_rows = convert_bkhd_to_upsse(make_bang_ke("Phủ Lý", 300, day_span=2), "Phủ Lý", static_data, output)
+    last_row = BLANK_LEADING_ROWS + 1 + n_rows
+
+    with zipfile.ZipFile(io.BytesIO(output.getvalue())) as zf:
+        sheet_xml = zf.read("xl/worksheets/sheet1.xml").decode("utf-8")
+    assert re.search(r'<dimension ref="([^"]+)"', sheet_xml).group(1) == f"A1:AK{last_row}"
+
+    ws = load_workbook(io.BytesIO(output.getvalue())).active
+    assert ws.max_row == last_row
+    assert all(cell.value is None for row in ws.iter_rows(max_row=BLANK_LEADING_ROWS) for cell in row)
+    assert [cell.value for cell in ws[BLANK_LEADING_ROWS + 1]] == headers
+    for row in ws.iter_rows(min_row=BLANK_LEADING_ROWS + 2):
+        for c, cell in enumerate(row, start=1):
+            if c in FORCED_TEXT_COLS:
+                assert cell.number_format == '@'
+            elif c == DATE_COL and cell.value is not None:
+                assert cell.number_format == 'DD/MM/YYYY'
+            elif cell.value and c not in EXCLUDE_TEXT_COLS:
+                assert cell.number_format == '@'
+    assert ws.column_dimensions['B'].width == 35
+
+# CSV/TSV: mã khách, số hóa đơn, các cột Tk ("131112") phải nằm trong nháy kép để Excel/SSE không đọc thành số;
+# chỉ NUMBER_COLS là số trần, ngày ghi ISO
+@pytest.mark.parametrize("output_format, delimiter", [("csv", ","), ("tsv", "\t")])
+def test_csv_tsv_quote_text_columns_and_iso_dates(make_bang_ke, static_data, output_format, delimiter):
+    output = io.BytesIO()
+    n_rows = convert_bkhd_to_upsse(make_bang_ke("Phủ Lý", 300, day_span=2), "Phủ Lý", static_data, output, output_format=output_format)
+    text = output.getvalue().decode("utf-8-sig")
+    # QUOTE_NONNUMERIC: ô không có nháy kép được đọc thành float, ô có nháy kép giữ nguyên chuỗi
+    rows = list(csv.reader(io.StringIO(text, newline=""), delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC))
+    assert rows[0] == headers
+    assert len(rows) == n_rows + 1
+    for row in rows[1:]:
+        for c, value in enumerate(row, start=1):
+            if c in NUMBER_COLS:
+                assert isinstance(value, float) or value == ""
+            else:
+                assert isinstance(value, str)
+        assert re.fullmatch(r"\d{4}-\d{2}-\d{2}", row[DATE_COL - 1])
+        assert row[0] and row[3]
+    assert "131112" in {row[headers.index("Tk nợ")] for row in rows[1:]}
+    assert f'{delimiter}"131112"{delimiter}' in text
+
+# Parquet: cột chữ string, NUMBER_COLS double, Ngày date32; có ngày không đọc được thì cả cột Ngày chuyển về string
+def test_parquet_schema_and_date_fallback(make_bang_ke, static_data):
+    pa = pytest.importorskip("pyarrow")
+    pq = pytest.importorskip("pyarrow.parquet")
+    rules = get_chxd_rules(static_data, "Phủ Lý")
+    rows = build_invoice_rows(iter_bkhd_rows(make_bang_ke("Phủ Lý", 300, day_span=2), rules.f5_full), rules)[0]
+
+    def write(rows):
+        output = io.BytesIO()
+        get_output_format("parquet").write(headers, rows, output)
+        return pq.read_table(io.BytesIO(output.getvalue()))
+
+    table = write(rows)
+    assert table.schema.names == headers
+    assert table.schema.types == [pa.float64() if c in NUMBER_COLS else pa.date32() if c == DATE_COL else pa.string()
+                                  for c in range(1, len(headers) + 1)]
+    assert table.num_rows == len(rows)
+    assert table.column("Ngày")[0].as_py() == rows[0].ngay
+    assert table.column("Tk nợ")[0].as_py() == "131112"
+
+    rows[0].ngay = "31/02/2025"
+    table = write(rows)
+    assert table.schema.field("Ngày").type == pa.string()
+    assert table.column("Ngày")[0].as_py() == "31/02/2025"
+    assert table.column("Ngày")[1].as_py() == str(rows[1].ngay)
@@ -0,0 +1,111 @@
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+
+RESULT_CACHE_VERSION = 1 # Tăng lên khi cách tạo file UpSSE thay đổi, để không trả về kết quả cũ từ bộ nhớ đệm trên đĩa
+CACHE_FILE_SUFFIX = ".bin" # Dùng chung cho mọi định dạng kết quả, định dạng đã nằm trong khóa
+
+def result_cache_key(file_bytes, chxd_name, data_version, output_format="xlsx"):
+    """Khóa của một kết quả: mã băm nội dung bảng kê, tên CHXD, phiên bản Data.xlsx và định dạng file kết quả."""
+    digest = hashlib.sha256()
+    digest.update(f"{RESULT_CACHE_VERSION}\0{chxd_name}\0{data_version}\0{output_format}\0".encode("utf-8"))
+    digest.update(file_bytes)
+    return digest.hexdigest()
+
+# --- Bộ nhớ đệm kết quả UpSSE (LRU, giới hạn theo tổng dung lượng) ---
+class ResultCache:
+    """
+    Giữ các file UpSSE đã tạo (dạng bytes) theo khóa result_cache_key.
+    Khi tổng dung lượng vượt max_bytes hoặc số kết quả vượt max_entries thì bỏ kết quả lâu không dùng nhất.
+    Nếu có cache_dir, kết quả được ghi thêm ra đĩa để dùng lại giữa các phiên và sau khi khởi động lại server;
+    thứ tự LRU trên đĩa theo thời điểm sửa file. Dùng được đồng thời từ nhiều luồng (mỗi phiên Streamlit là một luồng).
+    """
+    def __init__(self, max_bytes=200 << 20, max_entries=256, cache_dir=None):
+        self.max_bytes, self.max_entries, self.cache_dir = max_bytes, max_entries, cache_dir
+        self._entries = OrderedDict() # key -> bytes (None nếu chỉ nằm trên đĩa), cũ nhất ở đầu
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self.hits = self.misses = 0
+        if cache_dir:
+            os.makedirs(cache_dir, exist_ok=True)
+            self._load_disk_index()
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, key + CACHE_FILE_SUFFIX)
+
+    def _load_disk_index(self):
+        files = []
+        for name in os.listdir(self.cache_dir):
+            if not name.endswith(CACHE_FILE_SUFFIX): continue
+            try: stat = os.stat(os.path.join(self.cache_dir, name))
+            except OSError: continue
+            files.append((stat.st_mtime_ns, name[:-len(CACHE_FILE_SUFFIX)], stat.st_size))
+        for _, key, size in sorted(files):
+            self._entries[key], self._sizes[key] = None, size
+        self._remove_files(self._evict())
+
+    def total_bytes(self):
+        return sum(self._sizes.values())
+
+    def get(self, key):
+        """Trả về bytes của kết quả, hoặc None nếu chưa có. File trên đĩa được đọc ngoài khóa."""
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            data = self._entries[key]
+            if data is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return data
+        try: # Chỉ có trên đĩa
+            with open(self._path(key), "rb") as f:
+                data = f.read()
+            os.utime(self._path(key)) # Cập nhật thứ tự LRU trên đĩa
+        except OSError:
+            data = None
+        with self._lock:
+            if data is None:
+                if key in self._entries and self._entries[key] is None:
+                    del self._entries[key], self._sizes[key]
+                self.misses += 1
+                return None
+            if key in self._entries: # Có thể đã bị bỏ trong lúc đọc file, khi đó vẫn trả về nhưng không giữ lại
+                self._entries[key] = data
+                self._entries.move_to_end(key)
+            self.hits += 1
+            return data
+
+    def put(self, key, data):
+        """Ghi file ra đĩa trước (ngoài khóa), rồi mới đưa vào danh sách và bỏ bớt kết quả cũ."""
+        data = bytes(data)
+        if len(data) > self.max_bytes: return # Kết quả lớn hơn cả bộ nhớ đệm thì không giữ
+        if self.cache_dir:
+            tmp_path = f"{self._path(key)}.{os.getpid()}.{threading.get_ident()}.tmp"
+            try: # Ghi ra file tạm rồi đổi tên để không đọc phải file ghi dở
+                with open(tmp_path, "wb") as f:
+                    f.write(data)
+                os.replace(tmp_path, self._path(key))
+            except OSError:
+                if os.path.exists(tmp_path): os.remove(tmp_path)
+        with self._lock:
+            self._entries[key], self._sizes[key] = data, len(data)
+            self._entries.move_to_end(key)
+            evicted = self._evict()
+        self._remove_files(evicted)
+
+    def _evict(self):
+        """Bỏ các kết quả lâu không dùng nhất khỏi danh sách (gọi khi đang giữ khóa), trả về các khóa đã bỏ để xóa file sau."""
+        evicted, total = [], self.total_bytes()
+        while self._entries and (total > self.max_bytes or len(self._entries) > self.max_entries):
+            key, _ = self._entries.popitem(last=False)
+            total -= self._sizes.pop(key)
+            evicted.append(key)
+        return evicted
+
+    def _remove_files(self, keys):
+        if not self.cache_dir: return
+        for key in keys:
+            try: os.remove(self._path(key))
+            except OSError: pass
@@ -0,0 +1,161 @@
+"""
+Chuyển đổi hàng loạt bảng kê hóa đơn POS thành UpSSE.xlsx, không cần giao diện Streamlit.
+
+Ví dụ:
+    python upsse_cli.py bang_ke/ -o UpSSE/                      # tự nhận diện CHXD theo ký hiệu hóa đơn
+    python upsse_cli.py "bang_ke/*.xlsx" --chxd "Phủ Lý"          # mọi file thuộc cùng một CHXD
+    python upsse_cli.py bang_ke/ --map chxd_map.csv --workers 8   # chỉ định CHXD theo tên file
+    python upsse_cli.py bang_ke_luy_ke.xlsx --ledger upsse_ledger.sqlite3   # chỉ chuyển hóa đơn chưa chuyển trước đây
+    python upsse_cli.py bang_ke/ --format csv                   # CSV cho script đối chiếu (SSE chỉ nhập được .xlsx)
+
+File --map gồm các dòng "mẫu tên file,tên CHXD" (mẫu theo kiểu glob, ví dụ "NamHong_*.xlsx,Nam Hồng").
+Mỗi file đầu vào cho ra một file <tên file>_UpSSE.xlsx (hoặc .csv, .tsv, .parquet theo --format) trong thư mục -o,
+kèm báo cáo tổng hợp upsse_report.csv.
+"""
+import argparse
+import csv
+import glob
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from fnmatch import fnmatch
+from upsse_core import load_static_data_snapshot, detect_chxd, convert_bkhd_to_upsse, clean_string, BangKeError, PerfStats
+from upsse_ledger import InvoiceLedger, convert_bkhd_delta
+from upsse_writer import OUTPUT_FORMATS, get_output_format
+
+REPORT_FILE_NAME = "upsse_report.csv"
+
+# --- Thu thập danh sách file đầu vào ---
+def collect_input_files(inputs):
+    """Mỗi đầu vào có thể là file, thư mục (lấy mọi *.xlsx) hoặc mẫu glob. Bỏ qua file tạm ~$ của Excel."""
+    files = []
+    for item in inputs:
+        if os.path.isdir(item):
+            matched = sorted(glob.glob(os.path.join(item, "*.xlsx")))
+        elif os.path.isfile(item):
+            matched = [item]
+        else:
+            matched = sorted(glob.glob(item))
+        for path in matched:
+            if not os.path.basename(path).startswith("~$") and path not in files:
+                files.append(path)
+    return files
+
+def read_chxd_map(map_path):
+    """Đọc file ánh xạ 'mẫu tên file,tên CHXD' (bỏ qua dòng trống và dòng bắt đầu bằng #)."""
+    mapping = []
+    with open(map_path, newline="", encoding="utf-8-sig") as f:
+        for row in csv.reader(f):
+            if not row or not row[0].strip() or row[0].strip().startswith("#"): continue
+            if len(row) < 2:
+                raise ValueError(f"Dòng không hợp lệ trong {map_path}: {','.join(row)}")
+            mapping.append((row[0].strip(), clean_string(row[1])))
+    return mapping
+
+def chxd_for_file(path, chxd, chxd_map):
+    """CHXD của file: theo --chxd, rồi theo --map; None nghĩa là tự nhận diện theo ký hiệu hóa đơn."""
+    if chxd:
+        return clean_string(chxd)
+    for pattern, chxd_name in chxd_map:
+        if fnmatch(os.path.basename(path), pattern): return chxd_name
+    return None
+
+# --- Xử lý trong từng tiến trình con ---
+_worker_static_data = None
+_worker_ledger = None
+
+def _init_worker(static_data, ledger_path=None):
+    global _worker_static_data, _worker_ledger
+    _worker_static_data = static_data
+    _worker_ledger = InvoiceLedger(ledger_path) if ledger_path else None
+
+def _convert_one(path, chxd_name, output_path, engine, output_format="xlsx"):
+    """Chuyển đổi một file, trả về một dòng báo cáo (không ném lỗi để các file khác vẫn tiếp tục)."""
+    started = time.perf_counter()
+    result = {"file": path, "chxd": chxd_name or "", "status": "OK", "rows": 0, "seconds": 0.0, "output": "", "message": ""}
+    try:
+        if not chxd_name:
+            chxd_name = result["chxd"] = detect_chxd(path, _worker_static_data)
+        if _worker_ledger is None:
+            result["rows"] = convert_bkhd_to_upsse(path, chxd_name, _worker_static_data, output_path, engine=engine, output_format=output_format)
+        else:
+            stats = PerfStats()
+            result["rows"], new_invoice_count, skipped_count = convert_bkhd_delta(path, chxd_name, _worker_static_data, output_path, _worker_ledger, engine=engine, stats=stats, output_format=output_format)
+            result["message"] = f"{new_invoice_count} hóa đơn mới, bỏ qua {skipped_count} dòng đã chuyển"
+            if stats.context["batch"] == "reused": result["message"] += f" (ghi lại file đã tạo lúc {stats.context['batch_created_at'].replace('T', ' ')})"
+        result["output"] = output_path if result["rows"] else ""
+    except BangKeError as e:
+        result["status"], result["message"] = "Lỗi", str(e)
+    except Exception as e:
+        result["status"], result["message"] = "Lỗi", f"Lỗi trong quá trình xử lý file: {e}"
+    result["seconds"] = round(time.perf_counter() - started, 3)
+    return result
+
+def output_path_for(path, output_dir, extension=".xlsx"):
+    stem = os.path.splitext(os.path.basename(path))[0]
+    return os.path.join(output_dir, f"{stem}_UpSSE{extension}")
+
+# --- Chạy song song trên nhiều nhân CPU ---
+def run_batch(files, static_data, output_dir, chxd=None, chxd_map=(), workers=None, engine="loop", ledger_path=None, progress=print, output_format="xlsx"):
+    """
+    Chuyển đổi các file trên một process pool, trả về danh sách dòng báo cáo theo đúng thứ tự files.
+    Có ledger_path thì chỉ chuyển hóa đơn mới và xử lý lần lượt từng file, để hai bảng kê chồng nhau không cùng nhận một hóa đơn là mới.
+    """
+    if ledger_path: workers = 1
+    extension = get_output_format(output_format).extension
+    os.makedirs(output_dir, exist_ok=True)
+    outputs = {}
+    for path in files:
+        out = output_path_for(path, output_dir, extension)
+        if out in outputs.values(): # Hai file trùng tên ở hai thư mục khác nhau
+            out = output_path_for(f"{os.path.basename(os.path.dirname(os.path.abspath(path)))}_{os.path.basename(path)}", output_dir, extension)
+        outputs[path] = out
+
+    results = {}
+    with ProcessPoolExecutor(max_workers=workers, initializer=_init_worker, initargs=(static_data, ledger_path)) as pool:
+        futures = {pool.submit(_convert_one, path, chxd_for_file(path, chxd, chxd_map), outputs[path], engine, output_format): path for path in files}
+        for done, future in enumerate(as_completed(futures), start=1):
+            result = results[futures[future]] = future.result()
+            progress(f"[{done}/{len(files)}] {result['status']:3} {result['file']} ({result['chxd'] or '?'}, {result['rows']} dòng, {result['seconds']}s) {result['message']}")
+    return [results[path] for path in files]
+
+def write_report(results, report_path):
+    with open(report_path, "w", newline="", encoding="utf-8-sig") as f: # utf-8-sig để Excel hiển thị đúng tiếng Việt
+        writer = csv.DictWriter(f, fieldnames=["file", "chxd", "status", "rows", "seconds", "output", "message"])
+        writer.writeheader()
+        writer.writerows(results)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Chuyển đổi hàng loạt bảng kê hóa đơn POS thành UpSSE.xlsx.")
+    parser.add_argument("inputs", nargs="+", help="File, thư mục hoặc mẫu glob của các bảng kê (.xlsx)")
+    parser.add_argument("-o", "--output-dir", default="UpSSE", help="Thư mục ghi kết quả (mặc định: UpSSE)")
+    parser.add_argument("--chxd", help="Tên CHXD dùng cho mọi file")
+    parser.add_argument("--map", dest="map_path", help="File CSV 'mẫu tên file,tên CHXD'")
+    parser.add_argument("--data", default="Data.xlsx", help="Đường dẫn Data.xlsx (mặc định: Data.xlsx)")
+    parser.add_argument("--workers", type=int, default=None, help="Số tiến trình song song (mặc định: số nhân CPU)")
+    parser.add_argument("--engine", choices=["loop", "pandas"], default="loop", help="Engine chuyển đổi (mặc định: loop)")
+    parser.add_argument("--format", dest="output_format", choices=list(OUTPUT_FORMATS), default="xlsx",
+                        help="Định dạng file kết quả (mặc định: xlsx để nhập SSE; csv, tsv, parquet cho đối chiếu, phân tích)")
+    parser.add_argument("--ledger", help="Sổ SQLite các hóa đơn đã chuyển: chỉ chuyển hóa đơn mới và ghi nhận vào sổ")
+    args = parser.parse_args(argv)
+
+    files = collect_input_files(args.inputs)
+    if not files:
+        print("Không tìm thấy file bảng kê nào.", file=sys.stderr)
+        return 2
+    static_data = load_static_data_snapshot(args.data)
+    chxd_map = read_chxd_map(args.map_path) if args.map_path else []
+
+    started = time.perf_counter()
+    results = run_batch(files, static_data, args.output_dir, chxd=args.chxd, chxd_map=chxd_map, workers=args.workers, engine=args.engine, ledger_path=args.ledger,
+                        output_format=args.output_format)
+    report_path = os.path.join(args.output_dir, REPORT_FILE_NAME)
+    write_report(results, report_path)
+
+    failed = sum(1 for r in results if r["status"] != "OK")
+    print(f"Xong {len(results) - failed}/{len(results)} file trong {time.perf_counter() - started:.1f}s. Báo cáo: {report_path}")
+    return 1 if failed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
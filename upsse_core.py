@@ -0,0 +1,633 @@
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import json
+import logging
+import os
+import re # Import regex module
+import sys
+import time
+try:
+    import resource
+except ImportError: # Windows không có module resource
+    resource = None
+from upsse_writer import get_output_format, CANCEL_CHECK_ROWS
+
+# Định nghĩa tiêu đề cho file UpSSE.xlsx
+headers = ["Mã khách", "Tên khách hàng", "Ngày", "Số hóa đơn", "Ký hiệu", "Diễn giải", "Mã hàng", "Tên mặt hàng",
+           "Đvt", "Mã kho", "Mã vị trí", "Mã lô", "Số lượng", "Giá bán", "Tiền hàng", "Mã nt", "Tỷ giá", "Mã thuế",
+           "Tk nợ", "Tk doanh thu", "Tk giá vốn", "Tk thuế có", "Cục thuế", "Vụ việc", "Bộ phận", "Lsx", "Sản phẩm",
+           "Hợp đồng", "Phí", "Khế ước", "Nhân viên bán", "Tên KH(thuế)", "Địa chỉ (thuế)", "Mã số Thuế",
+           "Nhóm Hàng", "Ghi chú", "Tiền thuế"]
+
+# Vị trí các cột cần lấy từ bảng kê POS (theo thứ tự cột sau khi sắp xếp lại)
+vi_tri_cu_idx = [0, 1, 2, 3, 4, 5, 7, 6, 8, 10, 11, 13, 14, 16]
+
+# Các mặt hàng được gộp dòng tổng hợp khi "Người mua không lấy hóa đơn"
+NO_INVOICE_PRODUCTS = ["Xăng E5 RON 92-II", "Xăng RON 95-III", "Dầu DO 0,05S-II", "Dầu DO 0,001S-V"]
+
+# --- Hàm trợ giúp chuyển đổi giá trị sang float an toàn ---
+def to_float(value):
+    """Chuyển đổi giá trị sang float, trả về 0.0 nếu không thể chuyển đổi."""
+    try:
+        if isinstance(value, str):
+            value = value.replace(",", "").strip()
+        return float(value)
+    except (ValueError, TypeError):
+        return 0.0
+
+# --- Hàm làm sạch chuỗi (loại bỏ mọi loại khoảng trắng và chuẩn hóa) ---
+def clean_string(s):
+    if s is None:
+        return ""
+    s = re.sub(r'\s+', ' ', str(s)).strip()
+    return s
+
+# --- Hàm đọc dữ liệu tĩnh và bảng tra cứu từ Data.xlsx ---
+def load_static_data(file_path):
+    """
+    Đọc dữ liệu và xây dựng các bảng tra cứu từ Data.xlsx.
+    Sử dụng openpyxl để đọc dữ liệu. Không phụ thuộc Streamlit để CLI và các chương trình khác dùng chung.
+    """
+    from openpyxl import load_workbook # Nạp openpyxl khi cần đọc file, không làm chậm lúc khởi động giao diện
+    wb = load_workbook(file_path, data_only=True)
+    ws = wb.active
+
+    listbox_data = []
+    chxd_detail_map = {}
+    store_specific_x_lookup = {}
+    
+    for row_idx in range(4, ws.max_row + 1):
+        row_data_values = [cell.value for cell in ws[row_idx]]
+
+        if len(row_data_values) < 18: continue
+
+        raw_chxd_name = row_data_values[10]
+        if raw_chxd_name and clean_string(raw_chxd_name):
+            chxd_name_str = clean_string(raw_chxd_name)
+            
+            if chxd_name_str and chxd_name_str not in listbox_data:
+                listbox_data.append(chxd_name_str)
+
+            g5_val = row_data_values[15]
+            f5_val_full = clean_string(row_data_values[16]) if row_data_values[16] is not None else ''
+            h5_val = clean_string(row_data_values[17]).lower() if row_data_values[17] is not None else ''
+            
+            if f5_val_full:
+                chxd_detail_map[chxd_name_str] = {
+                    'g5_val': g5_val, 'h5_val': h5_val,
+                    'f5_val_full': f5_val_full, 'b5_val': chxd_name_str
+                }
+            
+            # Column mapping for store_specific_x_lookup
+            # These indices are based on the Data.xlsx structure for X lookup values
+            store_specific_x_lookup[chxd_name_str] = {
+                "xăng e5 ron 92-ii": row_data_values[11], # Original column L
+                "xăng ron 95-iii":   row_data_values[12], # Original column M
+                "dầu do 0,05s-ii":   row_data_values[13], # Original column N
+                "dầu do 0,001s-v":   row_data_values[14]  # Original column O
+            }
+    
+    lookup_table = {} # For "Mã hàng" lookup (I4:J6 in Data.xlsx)
+    for row in ws.iter_rows(min_row=4, max_row=7, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: lookup_table[clean_string(row[0]).lower()] = row[1]
+    
+    tmt_lookup_table = {} # For "Thuế bảo vệ môi trường" lookup (I10:J13 in Data.xlsx)
+    for row in ws.iter_rows(min_row=10, max_row=13, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: tmt_lookup_table[clean_string(row[0]).lower()] = to_float(row[1])
+    
+    s_lookup_table = {} # For "Tk nợ" lookup (I29:J31 in Data.xlsx)
+    for row in ws.iter_rows(min_row=29, max_row=31, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: s_lookup_table[clean_string(row[0]).lower()] = row[1]
+    
+    t_lookup_regular = {} # For "Tk doanh thu" lookup (I33:J35 in Data.xlsx)
+    for row in ws.iter_rows(min_row=33, max_row=35, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: t_lookup_regular[clean_string(row[0]).lower()] = row[1]
+    
+    t_lookup_tmt = {} # For "Tk doanh thu" for TMT (I48:J50 in Data.xlsx)
+    for row in ws.iter_rows(min_row=48, max_row=50, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: t_lookup_tmt[clean_string(row[0]).lower()] = row[1]
+
+    v_lookup_table = {} # For "Tk thuế có" lookup (I53:J55 in Data.xlsx)
+    for row in ws.iter_rows(min_row=53, max_row=55, min_col=9, max_col=10, values_only=True):
+        if row[0] and row[1]: v_lookup_table[clean_string(row[0]).lower()] = row[1]
+    
+    u_value = ws['J36'].value # Value from J36 in Data.xlsx
+    wb.close()
+    
+    return {
+        "listbox_data": listbox_data, "lookup_table": lookup_table,
+        "tmt_lookup_table": tmt_lookup_table, "s_lookup_table": s_lookup_table,
+        "t_lookup_regular": t_lookup_regular, "t_lookup_tmt": t_lookup_tmt,
+        "v_lookup_table": v_lookup_table, "u_value": u_value,
+        "chxd_detail_map": chxd_detail_map, "store_specific_x_lookup": store_specific_x_lookup
+    }
+
+# --- Bản chụp (snapshot) các bảng tra cứu của Data.xlsx ---
+STATIC_SNAPSHOT_VERSION = 1 # Tăng lên khi thay đổi cấu trúc kết quả của load_static_data
+_static_data_memo = {} # file_path -> ((mtime, size), static_data) trong tiến trình hiện tại
+
+def file_content_hash(file_path):
+    """Mã băm SHA-256 của nội dung file, dùng làm phiên bản của Data.xlsx."""
+    digest = hashlib.sha256()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def static_snapshot_path(file_path):
+    return f"{file_path}.snapshot.json"
+
+def static_data_signature(file_path):
+    """(thời điểm sửa, kích thước) của Data.xlsx: đổi khi file được thay, dùng để biết lúc cần nạp lại mà không phải đọc file."""
+    stat = os.stat(file_path)
+    return stat.st_mtime_ns, stat.st_size
+
+def load_static_data_snapshot(file_path):
+    """
+    Trả về các bảng tra cứu của Data.xlsx, ưu tiên đọc từ file snapshot JSON nằm cạnh Data.xlsx.
+    Snapshot gắn với mã băm nội dung Data.xlsx, nên khi Data.xlsx thay đổi thì được dựng lại tự động.
+    Kết quả được giữ trong tiến trình và chỉ kiểm tra lại khi thời điểm sửa hoặc kích thước file thay đổi,
+    nhờ vậy thay Data.xlsx là có hiệu lực ngay mà không cần khởi động lại.
+    Kết quả có thêm khóa "data_version" (mã băm của Data.xlsx).
+    """
+    signature = static_data_signature(file_path)
+    memo = _static_data_memo.get(file_path)
+    if memo and memo[0] == signature:
+        return memo[1]
+
+    data_version = file_content_hash(file_path)
+    snapshot_path = static_snapshot_path(file_path)
+    static_data = None
+    try:
+        with open(snapshot_path, encoding='utf-8') as f:
+            snapshot = json.load(f)
+        if snapshot.get("version") == STATIC_SNAPSHOT_VERSION and snapshot.get("data_version") == data_version:
+            static_data = snapshot["static_data"]
+    except (OSError, ValueError, KeyError):
+        pass
+
+    if static_data is None:
+        static_data = load_static_data(file_path)
+        static_data["data_version"] = data_version
+        tmp_path = f"{snapshot_path}.{os.getpid()}.tmp"
+        try: # Ghi ra file tạm rồi đổi tên để tiến trình khác không đọc phải snapshot ghi dở
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                json.dump({"version": STATIC_SNAPSHOT_VERSION, "data_version": data_version, "static_data": static_data}, f, ensure_ascii=False)
+            os.replace(tmp_path, snapshot_path)
+        except (OSError, TypeError, ValueError): # Thư mục chỉ đọc hoặc giá trị không ghi được ra JSON: vẫn dùng kết quả vừa đọc
+            if os.path.exists(tmp_path): os.remove(tmp_path)
+
+    _static_data_memo[file_path] = (signature, static_data)
+    return static_data
+
+# --- Lỗi dữ liệu bảng kê (thông báo hiển thị trực tiếp cho người dùng) ---
+class BangKeError(Exception):
+    pass
+
+# --- Hàm đọc bảng kê dạng luồng (read-only) ---
+def iter_bkhd_rows(bkhd_file, f5_value_full):
+    """
+    Đọc lần lượt từng dòng dữ liệu của bảng kê mà không nạp toàn bộ sheet vào bộ nhớ.
+    Bỏ qua 4 dòng đầu, mỗi dòng trả về gồm các cột theo vi_tri_cu_idx và cờ "Yes"/"No" (có mã khách hay không).
+    Ngày (cột thứ 4) dạng 'dd-mm-yyyy' được chuyển thành date, ngày không đọc được giữ nguyên giá trị gốc.
+    Việc kiểm tra được làm ngay trên luồng dữ liệu và báo bằng BangKeError:
+    ký hiệu ở dòng đầu phải khớp với cửa hàng (f5_value_full), địa chỉ cột H không quá 128 ký tự, bảng kê phải có dữ liệu.
+    """
+    f5_norm = clean_string(f5_value_full)
+    if f5_norm.startswith('1'): f5_norm = f5_norm[1:]
+    long_cells, bkhd_row_count = [], 0
+
+    from openpyxl import load_workbook
+    bkhd_wb = load_workbook(bkhd_file, read_only=True)
+    try:
+        bkhd_ws = bkhd_wb.active
+        bkhd_ws.reset_dimensions() # Không dựa vào kích thước khai báo trong file, đọc đến dòng cuối thực tế
+        max_col = max(vi_tri_cu_idx) + 1
+        for r_idx, row in enumerate(bkhd_ws.iter_rows(max_col=max_col, values_only=True), start=1):
+            if row[7] and len(str(row[7])) > 128: long_cells.append(f"H{r_idx}")
+            if r_idx <= 4: continue
+            new_row = [row[i] for i in vi_tri_cu_idx]
+            if new_row[3]:
+                try: new_row[3] = datetime.strptime(str(new_row[3])[:10], '%d-%m-%Y').date()
+                except ValueError: pass
+            ma_kh = new_row[4]
+            new_row.append("No" if ma_kh is None or len(clean_string(ma_kh)) > 9 else "Yes")
+            bkhd_row_count += 1
+            if bkhd_row_count == 1 and f5_norm != clean_string(new_row[1]):
+                raise BangKeError("Bảng kê hóa đơn không phải của cửa hàng bạn chọn.")
+            yield new_row
+    finally:
+        bkhd_wb.close()
+
+    if long_cells:
+        raise BangKeError("Địa chỉ trên ô " + ', '.join(long_cells) + " quá dài, hãy điều chỉnh và thử lại.")
+    if not bkhd_row_count:
+        raise BangKeError("Không có dữ liệu hợp lệ trong file bảng kê sau khi xử lý.")
+
+# --- Dòng UpSSE ---
+class UpsseRow:
+    """
+    Một dòng của file UpSSE.xlsx. Chỉ giữ các trường thay đổi theo dòng (số lượng, giá, tiền là float, ngày là date);
+    các cột cố định của CHXD lấy từ rules và cả dòng chỉ được chuyển thành 37 ô khi ghi file (to_cells).
+    """
+    __slots__ = ("ma_khach", "ten_khach", "ngay", "so_hoa_don", "ky_hieu", "dien_giai", "ma_hang", "ten_mat_hang", "so_luong", "gia_ban",
+                 "tien_hang", "tk_doanh_thu", "vu_viec", "ten_kh_thue", "dia_chi_thue", "ma_so_thue", "tien_thue", "rules")
+
+    def __init__(self, ma_khach, ten_khach, ngay, so_hoa_don, ky_hieu, dien_giai, ma_hang, ten_mat_hang, so_luong, gia_ban,
+                 tien_hang, tk_doanh_thu, vu_viec, ten_kh_thue, dia_chi_thue, ma_so_thue, tien_thue, rules):
+        self.ma_khach, self.ten_khach, self.ngay, self.so_hoa_don, self.ky_hieu = ma_khach, ten_khach, ngay, so_hoa_don, ky_hieu
+        self.dien_giai, self.ma_hang, self.ten_mat_hang = dien_giai, ma_hang, ten_mat_hang
+        self.so_luong, self.gia_ban, self.tien_hang, self.tk_doanh_thu, self.vu_viec = so_luong, gia_ban, tien_hang, tk_doanh_thu, vu_viec
+        self.ten_kh_thue, self.dia_chi_thue, self.ma_so_thue, self.tien_thue, self.rules = ten_kh_thue, dia_chi_thue, ma_so_thue, tien_thue, rules
+
+    def to_cells(self):
+        """Giá trị 37 ô theo thứ tự headers."""
+        r = self.rules
+        return [self.ma_khach, self.ten_khach, self.ngay, self.so_hoa_don, self.ky_hieu, self.dien_giai, self.ma_hang, self.ten_mat_hang,
+                "Lít", r.g5, '', '', self.so_luong, self.gia_ban, self.tien_hang, '', '', 10,
+                r.tk_no, self.tk_doanh_thu, r.tk_gia_von, r.tk_thue_co, '', self.vu_viec, '', '', '', '', '', '', '',
+                self.ten_kh_thue, self.dia_chi_thue, self.ma_so_thue, '', '', self.tien_thue]
+
+# --- Bảng quy tắc của một CHXD (tính một lần từ Data.xlsx) ---
+NO_INVOICE_SUFFIX = {"Xăng E5 RON 92-II": "1", "Xăng RON 95-III": "2", "Dầu DO 0,05S-II": "3", "Dầu DO 0,001S-V": "4"} # Đuôi số hóa đơn tổng hợp
+NO_INVOICE_TMT_PER_LITER = {"Xăng E5 RON 92-II": 1900, "Xăng RON 95-III": 2000, "Dầu DO 0,05S-II": 1000, "Dầu DO 0,001S-V": 1000}
+SO_HD_PREFIX = {"Nguyễn Huệ": "HN", "Mai Linh": "MM"} # Các cửa hàng đánh số hóa đơn theo tiền tố riêng thay cho 2 ký tự cuối của ký hiệu
+NO_PRODUCT_RULE = ('', '', 0.0)
+
+class ChxdRules:
+    """
+    Các giá trị tra cứu của một CHXD: thông tin cửa hàng, tài khoản theo tỉnh (H5) và quy tắc của từng mặt hàng
+    (products: tên mặt hàng viết thường -> (mã hàng, mã vụ việc, đơn giá thuế BVMT)).
+    """
+    __slots__ = ("chxd_name", "g5", "h5", "b5", "f5_full", "so_hd_prefix", "tk_no", "tk_dt_regular", "tk_dt_tmt", "tk_gia_von", "tk_thue_co",
+                 "products", "lookup_table", "tmt_lookup_table", "x_lookup")
+
+    def __init__(self, static_data, chxd_name):
+        chxd_details, x_lookup_for_store = get_chxd_details(static_data, chxd_name)
+        self.chxd_name = clean_string(chxd_name)
+        self.g5, self.h5, self.b5, self.f5_full = chxd_details['g5_val'], chxd_details['h5_val'], chxd_details['b5_val'], chxd_details['f5_val_full']
+        self.so_hd_prefix = SO_HD_PREFIX.get(self.b5)
+        self.tk_no = static_data["s_lookup_table"].get(self.h5, '')
+        self.tk_dt_regular, self.tk_dt_tmt = static_data["t_lookup_regular"].get(self.h5, ''), static_data["t_lookup_tmt"].get(self.h5, '')
+        self.tk_gia_von, self.tk_thue_co = static_data["u_value"], static_data["v_lookup_table"].get(self.h5, '')
+        self.lookup_table, self.tmt_lookup_table, self.x_lookup = static_data["lookup_table"], static_data["tmt_lookup_table"], x_lookup_for_store
+        self.products = {k: (self.lookup_table.get(k, ''), x_lookup_for_store.get(k, ''), self.tmt_lookup_table.get(k, 0.0))
+                         for k in {*self.lookup_table, *self.tmt_lookup_table, *x_lookup_for_store}}
+
+    def product(self, product_key):
+        return self.products.get(product_key, NO_PRODUCT_RULE)
+
+    def summary_invoice_number(self, ngay, ky_hieu, product_name, lan_xuat=1):
+        """
+        Số hóa đơn của dòng tổng hợp: <tiền tố>BK<ngày>.<tháng>.<số thứ tự mặt hàng>.
+        Từ lần xuất thứ hai của cùng ngày, mặt hàng (chỉ chuyển hóa đơn mới) thêm -<lần xuất>, ví dụ PLBK01.05.1-2.
+        """
+        value_C = clean_string(ngay)
+        prefix = self.so_hd_prefix if self.so_hd_prefix is not None else clean_string(ky_hieu)[-2:]
+        so_hd = f"{prefix}BK{value_C[-2:]}.{value_C[5:7]}.{NO_INVOICE_SUFFIX.get(product_name, '')}"
+        return so_hd if lan_xuat == 1 else f"{so_hd}-{lan_xuat}"
+
+_chxd_rules_memo = {}
+
+def get_chxd_rules(static_data, chxd_name):
+    """
+    ChxdRules của CHXD, dựng một lần cho mỗi phiên bản Data.xlsx; báo BangKeError nếu Data.xlsx không có CHXD này.
+    static_data không có "data_version" (không qua load_static_data_snapshot) thì luôn dựng mới, không ghi nhớ.
+    """
+    data_version = static_data.get("data_version")
+    if not data_version:
+        return ChxdRules(static_data, chxd_name)
+    key = (data_version, clean_string(chxd_name))
+    rules = _chxd_rules_memo.get(key)
+    if rules is None:
+        rules = _chxd_rules_memo[key] = ChxdRules(static_data, chxd_name)
+    return rules
+
+# --- Dòng TMT tổng hợp ---
+def add_tmt_summary_row(product_name_full, rules, representative_date, representative_symbol, total_quantity_for_tmt, customer_name_for_summary_row, lan_xuat=1):
+    tmt_unit_value_for_summary = rules.tmt_lookup_table.get(product_name_full.lower(), 0)
+    tmt_amount = to_float(total_quantity_for_tmt) * to_float(tmt_unit_value_for_summary)
+    return UpsseRow(rules.g5, customer_name_for_summary_row, representative_date,
+                    rules.summary_invoice_number(representative_date, representative_symbol, product_name_full, lan_xuat), representative_symbol,
+                    '', "TMT", "Thuế bảo vệ môi trường", total_quantity_for_tmt, tmt_unit_value_for_summary,
+                    round(tmt_amount, 0), # Tiền hàng for TMT summary
+                    rules.tk_dt_tmt, rules.x_lookup.get(product_name_full.lower(), ''), "", '', '', round(tmt_amount * 0.1, 0), rules)
+
+# --- Functions for adding summary row for no invoice ---
+def new_no_invoice_totals():
+    """Bộ cộng dồn cho một mặt hàng 'Người mua không lấy hóa đơn', được cập nhật ngay trong vòng lặp chính."""
+    return {"so_dong": 0, "ngay": "", "ky_hieu": "", "so_luong": 0.0, "gia_ban_max": 0.0, "tien_hang": 0.0, "tien_thue": 0.0}
+
+def accumulate_no_invoice_row(totals, upsse_row, tien_hang_goc, tien_thue_goc):
+    """Cộng một dòng không lấy hóa đơn vào bộ cộng dồn (tiền hàng/tiền thuế lấy từ cột N/O gốc của bảng kê)."""
+    if totals["so_dong"] == 0:
+        totals["ngay"], totals["ky_hieu"] = upsse_row.ngay, upsse_row.ky_hieu # Date, Symbol (from first row)
+        totals["gia_ban_max"] = upsse_row.gia_ban
+    elif upsse_row.gia_ban > totals["gia_ban_max"]:
+        totals["gia_ban_max"] = upsse_row.gia_ban
+    totals["so_dong"] += 1
+    totals["so_luong"] += upsse_row.so_luong
+    totals["tien_hang"] += to_float(tien_hang_goc)
+    totals["tien_thue"] += to_float(tien_thue_goc)
+
+def add_summary_row_for_no_invoice(totals, product_name, rules, lan_xuat=1):
+    so_hd = rules.summary_invoice_number(totals["ngay"], totals["ky_hieu"], product_name, lan_xuat) # Date, Symbol (from first row)
+    total_M = totals["so_luong"] # Tổng 'Số lượng' của các dòng không lấy hóa đơn
+    price_per_liter = NO_INVOICE_TMT_PER_LITER.get(product_name, 0)
+    product_key = clean_string(product_name).lower()
+    return UpsseRow(rules.g5, f"Khách hàng mua {product_name} không lấy hóa đơn", totals["ngay"], so_hd, totals["ky_hieu"],
+                    f"Xuất bán lẻ theo hóa đơn số {so_hd}", rules.lookup_table.get(product_key, ''), product_name,
+                    total_M, totals["gia_ban_max"], # 'Giá bán' lớn nhất
+                    totals["tien_hang"] - round(total_M * price_per_liter, 0), rules.tk_dt_regular, rules.x_lookup.get(product_key, ''),
+                    f"Khách mua {product_name} không lấy hóa đơn", "", "",
+                    totals["tien_thue"] - round(total_M * price_per_liter * 0.1, 0), rules)
+
+def create_per_invoice_tmt_row(invoice_row, tmt_value):
+    tmt_amount = tmt_value * to_float(invoice_row.so_luong)
+    return UpsseRow(invoice_row.ma_khach, invoice_row.ten_khach, invoice_row.ngay, invoice_row.so_hoa_don, invoice_row.ky_hieu,
+                    '', "TMT", "Thuế bảo vệ môi trường", invoice_row.so_luong, tmt_value, round(tmt_amount, 0), # Tiền hàng for TMT row
+                    invoice_row.rules.tk_dt_tmt, invoice_row.vu_viec, "", '', '', round(tmt_amount * 0.1, 0), invoice_row.rules)
+
+# --- Dòng tổng hợp cho khách không lấy hóa đơn (dùng chung cho mọi engine) ---
+def build_no_invoice_summary_rows(no_invoice_totals, rules, lan_xuat=None):
+    """
+    Trả về (các dòng tổng hợp theo mặt hàng, các dòng TMT tổng hợp tương ứng).
+    lan_xuat: {mặt hàng: lần xuất} khi chỉ chuyển hóa đơn mới (xem ChxdRules.summary_invoice_number), mặc định là lần đầu.
+    """
+    summary_rows, tmt_summary_rows = [], []
+    for product_name, totals in no_invoice_totals.items():
+        if totals["so_dong"]:
+            lan = lan_xuat.get(product_name, 1) if lan_xuat else 1
+            summary_row = add_summary_row_for_no_invoice(totals, product_name, rules, lan)
+            summary_rows.append(summary_row)
+            tmt_summary_rows.append(add_tmt_summary_row(product_name, rules, summary_row.ngay, summary_row.ky_hieu, totals["so_luong"], summary_row.ten_khach, lan))
+    return summary_rows, tmt_summary_rows
+
+# --- Ký hiệu và số hóa đơn trên UpSSE của một dòng bảng kê ---
+def bkhd_invoice_key(row, rules):
+    """Trả về (ký hiệu, số hóa đơn) của dòng bảng kê row (từ iter_bkhd_rows) trên UpSSE."""
+    b_orig, c_orig = clean_string(row[1]), clean_string(row[2])
+    prefix = rules.so_hd_prefix if rules.so_hd_prefix is not None else b_orig[-2:]
+    return (f"1{b_orig}" if b_orig else ''), f"{prefix}{c_orig[-6:]}"
+
+# --- Engine mặc định: xử lý từng dòng bảng kê ---
+def build_invoice_rows(bkhd_rows, rules, by_day=False):
+    """
+    Chuyển các dòng bảng kê (từ iter_bkhd_rows) thành dòng UpSSE theo từng hóa đơn.
+    Trả về (dòng hóa đơn, dòng TMT theo hóa đơn, bộ cộng dồn cho khách không lấy hóa đơn theo mặt hàng).
+    by_day=True: bộ cộng dồn tách theo ngày, ký hiệu của từng dòng, {(ngày, ký hiệu): {mặt hàng: bộ cộng dồn}} theo thứ tự xuất hiện.
+    """
+    final_rows, all_tmt_rows = [], []
+    no_invoice_totals = {} if by_day else {p: new_no_invoice_totals() for p in NO_INVOICE_PRODUCTS}
+    g5_value, tk_dt_regular, product_rule = rules.g5, rules.tk_dt_regular, rules.product
+
+    for row in bkhd_rows:
+        ma_khach = clean_string(row[4]) if row[-1] == 'Yes' and row[4] and clean_string(row[4]) else g5_value
+        ten_khach = clean_string(row[5])
+        ky_hieu, so_hd = bkhd_invoice_key(row, rules)
+        product_name = clean_string(row[8])
+        ma_hang, vu_viec, tmt_value = product_rule(product_name.lower())
+        so_luong = to_float(row[9])
+        upsse_row = UpsseRow(ma_khach, ten_khach, row[3], so_hd, ky_hieu, f"Xuất bán lẻ theo hóa đơn số {so_hd}", ma_hang, product_name,
+                             so_luong, round(to_float(row[10]) / 1.1 - tmt_value, 2), to_float(row[11]) - round(tmt_value * so_luong),
+                             tk_dt_regular, vu_viec, ten_khach, row[6], row[7], to_float(row[12]) - round(so_luong * tmt_value * 0.1), rules)
+
+        if ten_khach == "Người mua không lấy hóa đơn" and product_name in NO_INVOICE_PRODUCTS:
+            if by_day:
+                group = no_invoice_totals.get((row[3], ky_hieu))
+                if group is None: group = no_invoice_totals[(row[3], ky_hieu)] = {p: new_no_invoice_totals() for p in NO_INVOICE_PRODUCTS}
+                accumulate_no_invoice_row(group[product_name], upsse_row, row[11], row[12])
+            else:
+                accumulate_no_invoice_row(no_invoice_totals[product_name], upsse_row, row[11], row[12])
+        else:
+            final_rows.append(upsse_row)
+            if tmt_value > 0 and so_luong > 0:
+                all_tmt_rows.append(create_per_invoice_tmt_row(upsse_row, tmt_value))
+
+    return final_rows, all_tmt_rows, no_invoice_totals
+
+# --- Chọn engine chuyển đổi ---
+def get_row_engine(name):
+    """
+    Trả về hàm xử lý dòng hóa đơn (cùng đầu vào/kết quả với build_invoice_rows, kể cả by_day) của engine:
+    'loop': xử lý từng dòng (mặc định), 'pandas': tính theo cột bằng pandas/NumPy. Hai engine cho kết quả giống hệt nhau.
+    """
+    if name == "loop":
+        return build_invoice_rows
+    if name == "pandas":
+        from upsse_vectorized import build_invoice_rows_vectorized
+        return build_invoice_rows_vectorized
+    raise ValueError(f"Engine không hợp lệ: {name!r} (chọn 'loop' hoặc 'pandas')")
+
+# --- Nhận diện cửa hàng từ ký hiệu hóa đơn trên bảng kê ---
+def read_bkhd_symbol(bkhd_file):
+    """Đọc ký hiệu hóa đơn (cột B) ở dòng dữ liệu đầu tiên của bảng kê (dòng 5), đã làm sạch."""
+    from openpyxl import load_workbook
+    bkhd_wb = load_workbook(bkhd_file, read_only=True)
+    try:
+        bkhd_ws = bkhd_wb.active
+        bkhd_ws.reset_dimensions()
+        for row in bkhd_ws.iter_rows(min_row=5, max_row=5, max_col=2, values_only=True):
+            return clean_string(row[1])
+        return ""
+    finally:
+        bkhd_wb.close()
+
+def detect_chxd(bkhd_file, static_data):
+    """
+    Tìm CHXD có ký hiệu hóa đơn (F5 trong Data.xlsx, bỏ số 1 đầu) trùng với ký hiệu trên bảng kê,
+    giống phép so sánh khi kiểm tra bảng kê có đúng cửa hàng hay không.
+    Báo BangKeError nếu không tìm thấy hoặc có nhiều cửa hàng dùng chung ký hiệu.
+    """
+    symbol = read_bkhd_symbol(bkhd_file)
+    matches = []
+    for chxd_name, details in static_data["chxd_detail_map"].items():
+        f5_norm = clean_string(details['f5_val_full'])
+        if f5_norm.startswith('1'): f5_norm = f5_norm[1:]
+        if f5_norm == symbol: matches.append(chxd_name)
+    if not matches:
+        raise BangKeError(f"Không tìm thấy CHXD có ký hiệu hóa đơn '{symbol}' trong Data.xlsx.")
+    if len(matches) > 1:
+        raise BangKeError(f"Ký hiệu '{symbol}' dùng chung cho nhiều CHXD ({', '.join(matches)}), hãy chỉ rõ tên CHXD.")
+    return matches[0]
+
+# --- Đo thời gian và bộ nhớ của từng công đoạn ---
+perf_logger = logging.getLogger("upsse.perf")
+
+def peak_rss_mb():
+    """Bộ nhớ đỉnh (RSS) của tiến trình từ lúc khởi động đến lúc gọi, theo MB; None nếu hệ điều hành không hỗ trợ."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1 << 20 if sys.platform == "darwin" else 1 << 10) # macOS tính theo byte, Linux theo KB
+
+def current_rss_mb():
+    """Bộ nhớ (RSS) tiến trình đang dùng lúc gọi, theo MB; None nếu không đọc được (chỉ hỗ trợ Linux, qua /proc)."""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1 << 20)
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+class TimedRows:
+    """
+    Bọc một iterator (dòng bảng kê), cộng dồn số dòng và thời gian nằm trong next(), tức thời gian đọc khi xử lý dạng luồng.
+    cancel_check(), nếu có, được gọi sau mỗi CANCEL_CHECK_ROWS dòng (dừng công việc đã bị hủy ngay giữa lúc đọc).
+    """
+    __slots__ = ("_rows", "rows", "seconds", "_cancel_check")
+
+    def __init__(self, rows, cancel_check=None):
+        self._rows, self.rows, self.seconds, self._cancel_check = iter(rows), 0, 0.0, cancel_check
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        started = time.perf_counter()
+        try:
+            row = next(self._rows)
+        finally:
+            self.seconds += time.perf_counter() - started
+        self.rows += 1
+        if self._cancel_check is not None and self.rows % CANCEL_CHECK_ROWS == 0: self._cancel_check()
+        return row
+
+class PerfStats:
+    """
+    Số đo của một lần chuyển đổi: thời gian, số dòng và bộ nhớ sau mỗi công đoạn.
+    Bộ nhớ gồm rss_mb (RSS của tiến trình lúc công đoạn kết thúc) và peak_growth_mb (đỉnh RSS của tiến trình tăng thêm bao nhiêu
+    kể từ lúc bắt đầu lần chuyển đổi này; 0 nếu chưa vượt đỉnh của các lần trước). Cả hai là số đo của cả tiến trình:
+    các công việc chạy đồng thời trong cùng tiến trình (hàng đợi của giao diện) được tính chung.
+    Chỉ gọi perf_counter, getrusage và đọc /proc ở đầu/cuối công đoạn nên gần như không tốn thêm thời gian.
+    listener(tên công đoạn), nếu có, được gọi khi bắt đầu mỗi công đoạn (báo tiến độ, dừng công việc đã bị hủy).
+    cancel_check(), nếu có, được gọi định kỳ bên trong các công đoạn dài (đọc bảng kê, ghi file) để dừng giữa chừng.
+    """
+    def __init__(self, listener=None, cancel_check=None, **context):
+        self.context = context # CHXD, tên file, kích thước file...
+        self.stages = []
+        self.listener, self.cancel_check = listener, cancel_check
+        self._start_peak_mb = peak_rss_mb()
+
+    @contextmanager
+    def stage(self, name):
+        """Đo một công đoạn; gán record["rows"] bên trong khối with để ghi lại số dòng."""
+        if self.listener is not None: self.listener(name)
+        record = {"stage": name, "rows": None}
+        started = time.perf_counter()
+        try:
+            yield record
+        finally:
+            record["seconds"] = round(time.perf_counter() - started, 4)
+            self._record_memory(record)
+            self.stages.append(record)
+
+    def _record_memory(self, record):
+        rss, peak = current_rss_mb(), peak_rss_mb()
+        record["rss_mb"] = None if rss is None else round(rss, 1)
+        record["peak_growth_mb"] = None if peak is None else round(max(peak - self._start_peak_mb, 0.0), 1)
+
+    def split_stage(self, name, part_name, seconds, rows):
+        """
+        Tách phần thời gian seconds của công đoạn name (đã đo) thành công đoạn part_name đứng ngay trước nó,
+        dùng khi hai công đoạn chạy xen kẽ theo luồng (đọc bảng kê trong lúc chuyển đổi).
+        """
+        i = next(i for i, s in enumerate(self.stages) if s["stage"] == name)
+        record = self.stages[i]
+        seconds = round(min(seconds, record["seconds"]), 4)
+        record["seconds"] = round(record["seconds"] - seconds, 4)
+        self.stages.insert(i, {**record, "stage": part_name, "rows": rows, "seconds": seconds})
+
+    def total_seconds(self):
+        return round(sum(s["seconds"] for s in self.stages), 4)
+
+    def to_dict(self):
+        return {**self.context, "total_seconds": self.total_seconds(), "stages": self.stages}
+
+def log_perf_stats(stats, status="OK"):
+    """Ghi số đo ra logger "upsse.perf" dưới dạng một dòng JSON, để tổng hợp độ trễ theo cửa hàng về sau."""
+    record = {"event": "upsse_convert", "time": datetime.now().isoformat(timespec="seconds"), "status": status, **stats.to_dict()}
+    perf_logger.info(json.dumps(record, ensure_ascii=False, default=str))
+
+# --- Chuyển đổi một bảng kê thành UpSSE.xlsx (dùng chung cho giao diện Streamlit và CLI) ---
+def get_chxd_details(static_data, chxd_name):
+    """Trả về (thông tin CHXD, bảng mã Vụ việc của CHXD); báo BangKeError nếu Data.xlsx không có CHXD này."""
+    chxd_name = clean_string(chxd_name)
+    if chxd_name not in static_data["chxd_detail_map"]:
+        raise BangKeError(f"Không tìm thấy thông tin chi tiết cho CHXD: '{chxd_name}'")
+    return static_data["chxd_detail_map"][chxd_name], static_data["store_specific_x_lookup"].get(chxd_name, {})
+
+def read_and_transform_bkhd(bkhd_file, chxd_name, static_data, engine="loop", stats=None, by_day=False):
+    """
+    Đọc bảng kê và dựng dòng hóa đơn: trả về (dòng hóa đơn, dòng TMT theo hóa đơn, bộ cộng dồn không lấy hóa đơn).
+    Bảng kê được đọc dạng luồng ngay trong lúc chuyển đổi (engine loop không giữ cả bảng kê trong bộ nhớ; engine pandas
+    cần cả bảng kê để tính theo cột). Thời gian nằm trong việc đọc được tách thành công đoạn ingest, phần còn lại là transform.
+    by_day=True (gộp nhiều bảng kê): bộ cộng dồn tách theo ngày, ký hiệu của từng dòng, xem build_invoice_rows.
+    """
+    rules = get_chxd_rules(static_data, chxd_name)
+    row_engine = get_row_engine(engine)
+    stats = stats if stats is not None else PerfStats()
+    bkhd_rows = TimedRows(iter_bkhd_rows(bkhd_file, rules.f5_full), stats.cancel_check)
+    with stats.stage("transform") as record: # Mở workbook, đọc bảng kê, dựng dòng hóa đơn và dòng TMT theo hóa đơn
+        invoice_rows, all_tmt_rows, no_invoice_totals = row_engine(bkhd_rows, rules, by_day=by_day)
+        record["rows"] = len(invoice_rows) + len(all_tmt_rows)
+    stats.split_stage("transform", "ingest", bkhd_rows.seconds, bkhd_rows.rows)
+    return invoice_rows, all_tmt_rows, no_invoice_totals
+
+def convert_bkhd_to_upsse(bkhd_file, chxd_name, static_data, output, engine="loop", stats=None, output_format="xlsx"):
+    """
+    Đọc bảng kê bkhd_file của cửa hàng chxd_name, ghi file UpSSE.xlsx vào output (đường dẫn hoặc file-like).
+    output_format chọn định dạng file kết quả (xem upsse_writer.OUTPUT_FORMATS), mặc định là UpSSE.xlsx để nhập vào SSE.
+    Trả về số dòng dữ liệu đã ghi (không tính 4 dòng trống và dòng tiêu đề). Lỗi dữ liệu được báo bằng BangKeError.
+    Nếu có stats (PerfStats), thời gian từng công đoạn (ingest, transform, summaries, write_<định dạng>) được ghi vào đó.
+    """
+    rules = get_chxd_rules(static_data, chxd_name)
+    writer = get_output_format(output_format)
+    stats = stats if stats is not None else PerfStats()
+    invoice_rows, all_tmt_rows, no_invoice_totals = read_and_transform_bkhd(bkhd_file, chxd_name, static_data, engine, stats)
+    with stats.stage("summaries") as record: # Dòng tổng hợp không lấy hóa đơn và TMT tổng hợp
+        summary_rows, tmt_summary_rows = build_no_invoice_summary_rows(no_invoice_totals, rules)
+        record["rows"] = len(summary_rows) + len(tmt_summary_rows)
+    final_rows = invoice_rows + summary_rows + all_tmt_rows + tmt_summary_rows
+    with stats.stage(f"write_{writer.name}") as record: # Định dạng ô và lưu file
+        writer.write(headers, final_rows, output, stats.cancel_check)
+        record["rows"] = len(final_rows)
+    return len(final_rows)
+
+# --- Gộp nhiều bảng kê của cùng một CHXD thành một file UpSSE.xlsx ---
+def merge_no_invoice_totals(totals_per_group):
+    """
+    Gộp các bộ cộng dồn "không lấy hóa đơn" (mỗi bộ {mặt hàng: bộ cộng dồn} thuộc một ngày, ký hiệu, xem build_invoice_rows với by_day=True)
+    theo ngày và ký hiệu.
+    Trả về {(ngày, ký hiệu): {mặt hàng: bộ cộng dồn}} theo thứ tự ngày, ký hiệu.
+    """
+    groups = {}
+    for no_invoice_totals in totals_per_group:
+        for product_name, totals in no_invoice_totals.items():
+            if not totals["so_dong"]: continue
+            group = groups.setdefault((totals["ngay"], totals["ky_hieu"]), {p: new_no_invoice_totals() for p in NO_INVOICE_PRODUCTS})
+            merged = group[product_name]
+            if merged["so_dong"] == 0:
+                merged["ngay"], merged["ky_hieu"], merged["gia_ban_max"] = totals["ngay"], totals["ky_hieu"], totals["gia_ban_max"]
+            elif totals["gia_ban_max"] > merged["gia_ban_max"]:
+                merged["gia_ban_max"] = totals["gia_ban_max"]
+            for key in ("so_dong", "so_luong", "tien_hang", "tien_thue"):
+                merged[key] += totals[key]
+    return {key: groups[key] for key in sorted(groups, key=lambda k: (str(k[0]), str(k[1])))}
+
+def build_merged_upsse_rows(parts, chxd_name, static_data):
+    """
+    Ghép kết quả read_and_transform_bkhd(..., by_day=True) của nhiều bảng kê (theo thứ tự parts) thành các dòng của một file UpSSE:
+    dòng hóa đơn, dòng tổng hợp không lấy hóa đơn theo từng ngày/ký hiệu, dòng TMT theo hóa đơn, dòng TMT tổng hợp.
+    Gộp một bảng kê chỉ có một ngày, một ký hiệu cho đúng các dòng như chuyển riêng bảng kê đó.
+    """
+    rules = get_chxd_rules(static_data, chxd_name)
+    invoice_rows, summary_rows, all_tmt_rows, tmt_summary_rows = [], [], [], []
+    for part_invoice_rows, part_tmt_rows, _ in parts:
+        invoice_rows.extend(part_invoice_rows)
+        all_tmt_rows.extend(part_tmt_rows)
+    for group_totals in merge_no_invoice_totals([totals for _, _, groups in parts for totals in groups.values()]).values():
+        group_summary_rows, group_tmt_summary_rows = build_no_invoice_summary_rows(group_totals, rules)
+        summary_rows.extend(group_summary_rows)
+        tmt_summary_rows.extend(group_tmt_summary_rows)
+    return invoice_rows + summary_rows + all_tmt_rows + tmt_summary_rows
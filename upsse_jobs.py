@@ -0,0 +1,112 @@
+import itertools
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+QUEUED, RUNNING, DONE, FAILED, CANCELLED = "queued", "running", "done", "failed", "cancelled"
+
+class JobCancelled(Exception):
+    """Ném ra trong công việc khi người dùng đã bấm hủy (kiểm tra ở đầu mỗi công đoạn và sau mỗi CANCEL_CHECK_ROWS dòng khi đọc, ghi)."""
+    pass
+
+# --- Một lần xử lý được đưa vào hàng đợi ---
+class Job:
+    def __init__(self, job_id, label):
+        self.id, self.label = job_id, label
+        self.status, self.progress, self.stage = QUEUED, 0.0, "Đang chờ đến lượt xử lý..."
+        self.result, self.error = None, None
+        self.created_at, self.finished_at = time.time(), None
+        self._cancel_event = threading.Event()
+        self._future = None
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED, CANCELLED)
+
+    def cancel(self):
+        """Hủy ngay nếu chưa chạy; nếu đang chạy thì dừng ở công đoạn tiếp theo."""
+        self._cancel_event.set()
+        if self._future is not None and self._future.cancel():
+            self.status, self.finished_at = CANCELLED, time.time()
+
+    def check_cancelled(self):
+        """Báo JobCancelled nếu công việc đã bị hủy; gọi định kỳ trong các vòng lặp dài (đọc bảng kê, ghi file)."""
+        if self._cancel_event.is_set():
+            raise JobCancelled()
+
+    def update(self, progress, stage):
+        """Cập nhật tiến độ (0..1) và tên công đoạn; báo JobCancelled nếu công việc đã bị hủy."""
+        self.check_cancelled()
+        self.progress, self.stage = min(max(progress, 0.0), 1.0), stage
+
+    @property
+    def result_bytes(self):
+        """Dung lượng file kết quả (result["data"]) đang được giữ trong bộ nhớ."""
+        data = self.result.get("data") if isinstance(self.result, dict) else None
+        return len(data) if isinstance(data, (bytes, bytearray)) else 0
+
+# --- Hàng đợi dùng chung cho mọi phiên ---
+class JobQueue:
+    """
+    Chạy các công việc trên một thread pool có giới hạn, dùng chung cho mọi phiên Streamlit:
+    số bảng kê được xử lý cùng lúc (và bộ nhớ, CPU dùng cho chúng) không vượt quá max_workers, các công việc khác chờ đến lượt.
+    Công việc đã xong được giữ lại ttl_seconds giây để người dùng vẫn tải được kết quả sau khi trang chạy lại;
+    khi tổng dung lượng kết quả vượt max_result_bytes thì bỏ bớt các công việc đã xong ít được xem lại nhất (LRU).
+    """
+    def __init__(self, max_workers=2, ttl_seconds=3600, max_result_bytes=None):
+        self.ttl_seconds = ttl_seconds
+        self.max_result_bytes = max_result_bytes
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="upsse-job")
+        self._jobs = OrderedDict() # Thứ tự dùng gần nhất: get() đưa công việc về cuối
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def submit(self, label, func):
+        """func(job) chạy trong thread pool, giá trị trả về được lưu vào job.result."""
+        with self._lock:
+            self._purge()
+            job = Job(f"{next(self._ids)}-{int(time.time())}", label)
+            self._jobs[job.id] = job
+        job._future = self._pool.submit(self._run, job, func)
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            self._purge()
+            job = self._jobs.get(job_id)
+            if job is not None: self._jobs.move_to_end(job_id)
+            return job
+
+    def active_count(self):
+        with self._lock:
+            return sum(1 for job in self._jobs.values() if not job.finished)
+
+    def _run(self, job, func):
+        if job._cancel_event.is_set():
+            job.status, job.finished_at = CANCELLED, time.time()
+            return
+        job.status = RUNNING
+        try:
+            job.result = func(job)
+            job.status, job.progress = DONE, 1.0
+        except JobCancelled:
+            job.status = CANCELLED
+        except Exception as e:
+            job.status, job.error = FAILED, e
+        finally:
+            job.finished_at = time.time()
+            with self._lock:
+                self._purge()
+
+    def _purge(self):
+        now = time.time()
+        for job_id in [j.id for j in self._jobs.values() if j.finished and j.finished_at is not None and now - j.finished_at > self.ttl_seconds]:
+            del self._jobs[job_id]
+        if self.max_result_bytes is None: return
+        held = [j for j in self._jobs.values() if j.finished and j.result_bytes]
+        total = sum(j.result_bytes for j in held)
+        for job in held[:-1]: # Luôn giữ kết quả dùng gần nhất, kể cả khi một mình nó đã vượt giới hạn
+            if total <= self.max_result_bytes: break
+            total -= job.result_bytes
+            del self._jobs[job.id]
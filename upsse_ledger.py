@@ -0,0 +1,194 @@
+import hashlib
+import io
+import sqlite3
+import threading
+from itertools import islice
+from datetime import date, datetime, timedelta
+from upsse_core import (headers, iter_bkhd_rows, get_row_engine, get_chxd_rules, bkhd_invoice_key, build_no_invoice_summary_rows,
+                        merge_no_invoice_totals, clean_string, PerfStats, TimedRows)
+from upsse_writer import get_output_format
+
+SQLITE_MAX_VARIABLES = 500 # Số tham số tối đa trong một câu truy vấn IN (...)
+BATCH_KEEP_DAYS = 62 # Số ngày giữ lại file của mỗi lần chuyển hóa đơn mới để tải lại (bảng kê lũy kế theo tháng)
+
+def _date_text(value):
+    """Ngày ghi vào sổ dạng 'yyyy-mm-dd'; ngày không đọc được từ bảng kê giữ nguyên giá trị gốc."""
+    return value.isoformat() if isinstance(value, date) else value
+
+def delta_batch_key(bkhd_file, chxd_name, output_format):
+    """Khóa của một lần chuyển hóa đơn mới: mã băm nội dung bảng kê (đường dẫn hoặc file-like, đọc xong trả về đầu file), CHXD và định dạng."""
+    digest = hashlib.sha256(f"{chxd_name}\0{output_format}\0".encode("utf-8"))
+    f = open(bkhd_file, "rb") if isinstance(bkhd_file, str) else bkhd_file
+    try:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    finally:
+        if f is bkhd_file: f.seek(0)
+        else: f.close()
+    return digest.hexdigest()
+
+def _write_bytes(data, output):
+    if isinstance(output, str):
+        with open(output, "wb") as f: f.write(data)
+    else:
+        output.write(data)
+
+# --- Sổ theo dõi các hóa đơn đã chuyển sang UpSSE (SQLite) ---
+class InvoiceLedger:
+    """
+    Ghi nhận hóa đơn đã chuyển theo (ký hiệu, số hóa đơn), tức upsse_row[4] và upsse_row[3],
+    cùng tổng "không lấy hóa đơn" đã xuất và số lần đã xuất dòng tổng hợp theo CHXD, ngày, ký hiệu và mặt hàng.
+    File kết quả của mỗi lần chuyển được giữ BATCH_KEEP_DAYS ngày theo delta_batch_key để tải lại khi đưa lại đúng bảng kê đó.
+    Dùng chung được giữa các luồng (mỗi phiên Streamlit là một luồng); chxd_lock giữ cho các lần chuyển cùng CHXD chạy lần lượt.
+    """
+    def __init__(self, db_path):
+        self.db_path = db_path
+        self._conn = sqlite3.connect(db_path, check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._chxd_locks = {}
+        with self._lock, self._conn:
+            self._conn.executescript("""
+                CREATE TABLE IF NOT EXISTS invoices (
+                    ky_hieu TEXT NOT NULL, so_hoa_don TEXT NOT NULL, chxd TEXT, ngay TEXT, processed_at TEXT,
+                    PRIMARY KEY (ky_hieu, so_hoa_don)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS idx_invoices_chxd_ngay ON invoices (chxd, ngay);
+                CREATE TABLE IF NOT EXISTS no_invoice_totals (
+                    chxd TEXT NOT NULL, ngay TEXT NOT NULL, ky_hieu TEXT NOT NULL, mat_hang TEXT NOT NULL,
+                    so_dong INTEGER, so_luong REAL, gia_ban_max REAL, tien_hang REAL, tien_thue REAL, lan_xuat INTEGER NOT NULL DEFAULT 1,
+                    PRIMARY KEY (chxd, ngay, ky_hieu, mat_hang)) WITHOUT ROWID;
+                CREATE TABLE IF NOT EXISTS batches (
+                    batch_key TEXT PRIMARY KEY, chxd TEXT, created_at TEXT,
+                    so_dong INTEGER, so_hoa_don_moi INTEGER, so_dong_bo_qua INTEGER, data BLOB);
+            """)
+            if "lan_xuat" not in [column[1] for column in self._conn.execute("PRAGMA table_info(no_invoice_totals)")]: # Sổ tạo trước khi có cột này: mỗi nhóm đã xuất một lần
+                self._conn.execute("ALTER TABLE no_invoice_totals ADD COLUMN lan_xuat INTEGER NOT NULL DEFAULT 1")
+
+    def close(self):
+        self._conn.close()
+
+    def chxd_lock(self, chxd_name):
+        """Khóa riêng của một CHXD, giữ từ lúc tra sổ đến lúc ghi sổ để hai lần chuyển cùng lúc không nhận cùng một hóa đơn là mới."""
+        with self._lock:
+            return self._chxd_locks.setdefault(chxd_name, threading.Lock())
+
+    def seen_invoices(self, keys):
+        """Trả về tập các (ký hiệu, số hóa đơn) trong keys đã có trong sổ."""
+        by_symbol = {}
+        for ky_hieu, so_hd in keys:
+            by_symbol.setdefault(ky_hieu, []).append(so_hd)
+        seen = set()
+        with self._lock:
+            for ky_hieu, numbers in by_symbol.items():
+                for i in range(0, len(numbers), SQLITE_MAX_VARIABLES):
+                    chunk = numbers[i:i + SQLITE_MAX_VARIABLES]
+                    query = f"SELECT so_hoa_don FROM invoices WHERE ky_hieu = ? AND so_hoa_don IN ({','.join('?' * len(chunk))})"
+                    seen.update((ky_hieu, so_hd) for (so_hd,) in self._conn.execute(query, [ky_hieu, *chunk]))
+        return seen
+
+    def summary_export_counts(self, chxd_name, groups):
+        """Số lần đã xuất dòng tổng hợp của các nhóm (ngày, ký hiệu, mặt hàng): trả về {(ngày, ký hiệu, mặt hàng): số lần}, nhóm chưa xuất thì không có."""
+        result = {}
+        with self._lock:
+            for ngay, ky_hieu, product_name in groups:
+                row = self._conn.execute("SELECT lan_xuat FROM no_invoice_totals WHERE chxd = ? AND ngay = ? AND ky_hieu = ? AND mat_hang = ?",
+                                         (chxd_name, _date_text(ngay), ky_hieu, product_name)).fetchone()
+                if row is not None: result[(ngay, ky_hieu, product_name)] = row[0]
+        return result
+
+    def batch(self, batch_key):
+        """Lần chuyển đã ghi theo khóa batch_key: dict (created_at, so_dong, so_hoa_don_moi, so_dong_bo_qua, data), None nếu chưa có."""
+        with self._lock:
+            row = self._conn.execute("SELECT created_at, so_dong, so_hoa_don_moi, so_dong_bo_qua, data FROM batches WHERE batch_key = ?", (batch_key,)).fetchone()
+        return None if row is None else dict(zip(("created_at", "so_dong", "so_hoa_don_moi", "so_dong_bo_qua", "data"), row))
+
+    def record(self, chxd_name, invoices, group_totals, batch_key=None, batch=None):
+        """
+        Ghi các hóa đơn mới ({(ký hiệu, số hóa đơn): ngày}) trong một giao dịch, cộng phần tăng thêm group_totals
+        ({(ngày, ký hiệu): {mặt hàng: bộ cộng dồn}}) vào tổng đã xuất và tăng số lần xuất của các nhóm đó.
+        Hóa đơn đã có trong sổ làm giao dịch bị hủy (sqlite3.IntegrityError) thay vì bị bỏ qua.
+        batch (so_dong, so_hoa_don_moi, so_dong_bo_qua, data) là file của lần chuyển này, được lưu cùng giao dịch theo batch_key;
+        các lần chuyển cũ hơn BATCH_KEEP_DAYS ngày bị xóa.
+        """
+        now = datetime.now()
+        processed_at = now.isoformat(timespec="seconds")
+        with self._lock, self._conn:
+            if batch_key is not None:
+                self._conn.execute("DELETE FROM batches WHERE created_at < ?", ((now - timedelta(days=BATCH_KEEP_DAYS)).isoformat(timespec="seconds"),))
+                self._conn.execute("INSERT OR REPLACE INTO batches VALUES (?, ?, ?, ?, ?, ?, ?)", (batch_key, chxd_name, processed_at, *batch))
+            self._conn.executemany("INSERT INTO invoices (ky_hieu, so_hoa_don, chxd, ngay, processed_at) VALUES (?, ?, ?, ?, ?)",
+                                   ((ky_hieu, so_hd, chxd_name, _date_text(ngay), processed_at) for (ky_hieu, so_hd), ngay in invoices.items()))
+            self._conn.executemany("INSERT INTO no_invoice_totals VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, 1) ON CONFLICT (chxd, ngay, ky_hieu, mat_hang) DO UPDATE SET "
+                                   "so_dong = so_dong + excluded.so_dong, so_luong = so_luong + excluded.so_luong, gia_ban_max = max(gia_ban_max, excluded.gia_ban_max), "
+                                   "tien_hang = tien_hang + excluded.tien_hang, tien_thue = tien_thue + excluded.tien_thue, lan_xuat = lan_xuat + 1",
+                                   ((chxd_name, _date_text(t["ngay"]), t["ky_hieu"], product_name, t["so_dong"], t["so_luong"], t["gia_ban_max"], t["tien_hang"], t["tien_thue"])
+                                    for totals in group_totals.values() for product_name, t in totals.items() if t["so_dong"]))
+
+# --- Chỉ chuyển các hóa đơn chưa có trong sổ ---
+def convert_bkhd_delta(bkhd_file, chxd_name, static_data, output, ledger, engine="loop", stats=None, output_format="xlsx"):
+    """
+    Như convert_bkhd_to_upsse nhưng chỉ đưa các hóa đơn chưa có trong ledger vào UpSSE.xlsx.
+    Dòng tổng hợp "không lấy hóa đơn" chỉ gồm phần tăng thêm của các ngày/mặt hàng có hóa đơn mới, không lặp lại phần đã xuất;
+    từ lần xuất thứ hai của cùng ngày, mặt hàng, số hóa đơn tổng hợp có thêm -<lần xuất> (PLBK01.05.1-2) để SSE nhập như một chứng từ mới.
+    Sau khi ghi file, các hóa đơn mới được ghi vào ledger cùng file vừa tạo: đưa lại đúng bảng kê đó (cùng CHXD, cùng định dạng)
+    thì nhận lại file đã tạo lần trước thay vì "không có hóa đơn mới", để không mất hóa đơn khi chưa tải được file về;
+    khi đó stats.context["batch"] là "reused" và stats.context["batch_created_at"] là thời điểm tạo file.
+    Trả về (số dòng đã ghi, số hóa đơn mới, số dòng bảng kê bỏ qua vì đã chuyển); không có hóa đơn mới thì không ghi file.
+    Bảng kê được đọc dạng luồng, chỉ giữ lại các dòng của hóa đơn mới.
+    Từ lúc tra sổ đến lúc ghi sổ giữ ledger.chxd_lock(chxd_name): các lần chuyển cùng CHXD chạy lần lượt.
+    """
+    chxd_name = clean_string(chxd_name)
+    rules = get_chxd_rules(static_data, chxd_name)
+    writer = get_output_format(output_format)
+    stats = stats if stats is not None else PerfStats()
+
+    with ledger.chxd_lock(chxd_name):
+        with stats.stage("batch_lookup"):
+            batch_key = delta_batch_key(bkhd_file, chxd_name, writer.name)
+            batch = ledger.batch(batch_key)
+        stats.context["batch"] = "reused" if batch is not None else "new"
+        if batch is not None:
+            stats.context["batch_created_at"] = batch["created_at"]
+            _write_bytes(batch["data"], output)
+            return batch["so_dong"], batch["so_hoa_don_moi"], batch["so_dong_bo_qua"]
+
+        bkhd_rows = TimedRows(iter_bkhd_rows(bkhd_file, rules.f5_full), stats.cancel_check)
+        with stats.stage("ledger_lookup") as record: # Đọc bảng kê theo từng đoạn, bỏ ngay các dòng thuộc hóa đơn đã chuyển
+            new_invoices, new_rows = {}, []
+            while True:
+                chunk = list(islice(bkhd_rows, SQLITE_MAX_VARIABLES))
+                if not chunk: break
+                keys = [bkhd_invoice_key(row, rules) for row in chunk]
+                seen = ledger.seen_invoices(set(keys))
+                for row, key in zip(chunk, keys):
+                    if key in seen: continue
+                    new_invoices.setdefault(key, row[3])
+                    new_rows.append(row)
+            record["rows"] = len(new_rows)
+        stats.split_stage("ledger_lookup", "ingest", bkhd_rows.seconds, bkhd_rows.rows)
+        skipped = bkhd_rows.rows - record["rows"]
+        if not new_invoices:
+            return 0, 0, skipped
+
+        with stats.stage("transform") as record:
+            invoice_rows, all_tmt_rows, new_totals = get_row_engine(engine)(new_rows, rules, by_day=True) # Tổng hợp đúng từng ngày, ký hiệu
+            record["rows"] = len(invoice_rows) + len(all_tmt_rows)
+        with stats.stage("summaries") as record: # Chỉ phần tăng thêm của các nhóm (ngày, ký hiệu, mặt hàng) có hóa đơn mới
+            new_groups = merge_no_invoice_totals(new_totals.values())
+            affected = [(ngay, ky_hieu, p) for (ngay, ky_hieu), totals in new_groups.items() for p, t in totals.items() if t["so_dong"]]
+            export_counts = ledger.summary_export_counts(chxd_name, affected)
+            summary_rows, tmt_summary_rows = [], []
+            for (ngay, ky_hieu), group_totals in new_groups.items():
+                lan_xuat = {p: export_counts.get((ngay, ky_hieu, p), 0) + 1 for p in group_totals}
+                group_summary_rows, group_tmt_summary_rows = build_no_invoice_summary_rows(group_totals, rules, lan_xuat)
+                summary_rows.extend(group_summary_rows)
+                tmt_summary_rows.extend(group_tmt_summary_rows)
+            record["rows"] = len(summary_rows) + len(tmt_summary_rows)
+        final_rows = invoice_rows + summary_rows + all_tmt_rows + tmt_summary_rows
+        with stats.stage(f"write_{writer.name}") as record:
+            buffer = io.BytesIO()
+            writer.write(headers, final_rows, buffer, stats.cancel_check)
+            _write_bytes(buffer.getvalue(), output)
+            record["rows"] = len(final_rows)
+        with stats.stage("ledger_record"):
+            ledger.record(chxd_name, new_invoices, new_groups, batch_key, (len(final_rows), len(new_invoices), skipped, buffer.getvalue()))
+        return len(final_rows), len(new_invoices), skipped
@@ -0,0 +1,94 @@
+import io
+import multiprocessing
+import os
+import zipfile
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from upsse_core import headers, read_and_transform_bkhd, convert_bkhd_to_upsse, build_merged_upsse_rows, BangKeError, PerfStats
+from upsse_writer import get_output_format
+
+MAX_WORKERS = 4 # Giới hạn số tiến trình xử lý song song cho mỗi lần bấm "Xử lý"
+MERGE_MODE, ZIP_MODE = "merge", "zip"
+
+# --- Xử lý một bảng kê trong tiến trình con ---
+_worker_static_data = None
+
+def _init_worker(static_data):
+    global _worker_static_data
+    _worker_static_data = static_data
+
+def _process_one(name, file_bytes, chxd_name, mode, engine, static_data=None, output_format="xlsx"):
+    """
+    Chế độ gộp: trả về dòng hóa đơn, dòng TMT và các bộ cộng dồn theo ngày, ký hiệu của bảng kê; chế độ zip: trả về bytes của file kết quả theo output_format.
+    Không ném lỗi để các file khác vẫn tiếp tục.
+    """
+    static_data = static_data if static_data is not None else _worker_static_data
+    stats = PerfStats(chxd=chxd_name, file_name=name, file_size=len(file_bytes), engine=engine)
+    result = {"name": name, "status": "OK", "message": "", "rows": 0, "data": None, "stats": stats}
+    try:
+        if mode == ZIP_MODE:
+            output = io.BytesIO()
+            result["rows"] = convert_bkhd_to_upsse(io.BytesIO(file_bytes), chxd_name, static_data, output, engine=engine, stats=stats, output_format=output_format)
+            result["data"] = output.getvalue()
+        else:
+            result["data"] = read_and_transform_bkhd(io.BytesIO(file_bytes), chxd_name, static_data, engine=engine, stats=stats, by_day=True)
+            result["rows"] = len(result["data"][0]) + len(result["data"][1])
+    except BangKeError as e:
+        result["status"], result["message"] = "Lỗi", str(e)
+    except Exception as e:
+        result["status"], result["message"] = "Lỗi", f"Lỗi trong quá trình xử lý file: {e}"
+    return result
+
+def zip_entry_name(name, used_names, extension=".xlsx"):
+    stem, entry = os.path.splitext(os.path.basename(name))[0], None
+    for i in range(1, len(used_names) + 2):
+        entry = f"{stem}_UpSSE{extension}" if i == 1 else f"{stem}_{i}_UpSSE{extension}"
+        if entry not in used_names: break
+    used_names.add(entry)
+    return entry
+
+# --- Xử lý nhiều bảng kê của cùng một CHXD ---
+def convert_bkhd_files(files, chxd_name, static_data, mode=MERGE_MODE, engine="loop", max_workers=MAX_WORKERS, progress=None, output_format="xlsx", cancel_check=None):
+    """
+    files: danh sách (tên file, bytes). Các bảng kê được đọc và chuyển đổi song song trên một process pool có giới hạn,
+    nên tổng thời gian gần bằng thời gian của file chậm nhất. progress(số file xong, tổng số file, tên file) được gọi sau mỗi file;
+    nếu progress ném lỗi thì các file chưa xử lý bị bỏ và lỗi được ném tiếp.
+    Trả về (kết quả từng file theo thứ tự files, bytes đầu ra): chế độ gộp cho một UpSSE.xlsx (None nếu có file lỗi),
+    chế độ zip cho file .zip gồm một UpSSE.xlsx cho mỗi bảng kê xử lý được (None nếu không file nào xử lý được).
+    output_format chọn định dạng của các file UpSSE (xem upsse_writer.OUTPUT_FORMATS).
+    cancel_check() được truyền cho hàm ghi file gộp (xem upsse_writer.write_upsse_xlsx).
+    """
+    writer = get_output_format(output_format)
+    results = {}
+    workers = max(1, min(max_workers, len(files), os.cpu_count() or 1))
+    if workers == 1: # Không cần tạo tiến trình con
+        for done, (name, file_bytes) in enumerate(files, start=1):
+            results[done - 1] = _process_one(name, file_bytes, chxd_name, mode, engine, static_data, output_format)
+            if progress: progress(done, len(files), name)
+    else: # spawn: không fork tiến trình server đang chạy nhiều luồng
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                 initializer=_init_worker, initargs=(static_data,)) as pool:
+            futures = {pool.submit(_process_one, name, file_bytes, chxd_name, mode, engine, None, output_format): i for i, (name, file_bytes) in enumerate(files)}
+            try:
+                for done, future in enumerate(as_completed(futures), start=1):
+                    result = results[futures[future]] = future.result()
+                    if progress: progress(done, len(files), result["name"])
+            except BaseException: # progress có thể dừng công việc (người dùng hủy): bỏ các file chưa bắt đầu
+                pool.shutdown(wait=False, cancel_futures=True)
+                raise
+    results = [results[i] for i in range(len(files))]
+
+    ok_results = [r for r in results if r["status"] == "OK"]
+    if mode == ZIP_MODE:
+        if not ok_results:
+            return results, None
+        output, used_names = io.BytesIO(), set()
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as zf:
+            for r in ok_results:
+                zf.writestr(zip_entry_name(r["name"], used_names, writer.extension), r["data"])
+        return results, output.getvalue()
+
+    if len(ok_results) != len(results): # Không gộp thiếu bảng kê
+        return results, None
+    output = io.BytesIO()
+    writer.write(headers, build_merged_upsse_rows([r["data"] for r in results], chxd_name, static_data), output, cancel_check)
+    return results, output.getvalue()
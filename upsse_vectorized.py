@@ -0,0 +1,110 @@
+import numpy as np
+import pandas as pd
+from itertools import repeat
+from upsse_core import to_float, NO_INVOICE_PRODUCTS, new_no_invoice_totals, UpsseRow
+
+# --- Hàm trợ giúp tính theo cột ---
+def _map_values(col, func):
+    """
+    Áp dụng func cho cả cột nhưng chỉ tính một lần cho mỗi giá trị chuỗi khác nhau (tên hàng, ký hiệu, tên khách... lặp lại rất nhiều).
+    Cột có giá trị không phải chuỗi thì áp dụng từng ô, vì factorize coi 1, 1.0 và True là một giá trị.
+    """
+    codes, uniques = pd.factorize(col, use_na_sentinel=False)
+    if all(u is None or isinstance(u, str) for u in uniques):
+        return pd.Series(np.array([func(u) for u in uniques], dtype=object)[codes], index=col.index, dtype=object)
+    return col.map(func).astype(object)
+
+def _clean_string(s):
+    """Giống clean_string nhưng nhanh hơn: str.split() tách theo đúng tập ký tự khoảng trắng mà \\s của re dùng."""
+    return "" if s is None else ' '.join(str(s).split())
+
+def _float_column(col):
+    if pd.api.types.infer_dtype(col, skipna=False) in ("integer", "floating", "mixed-integer-float"):
+        return col.to_numpy(dtype=float) # Cột toàn số: float() từng ô cũng cho đúng giá trị này
+    return np.array(_map_values(col, to_float).tolist(), dtype=float)
+
+def _sequential_sum(values):
+    """Cộng dồn lần lượt từng giá trị như vòng lặp (không dùng pairwise/Kahan) để kết quả trùng khớp từng bit."""
+    return float(np.cumsum(np.concatenate(([0.0], values)))[-1])
+
+def _fill_no_invoice_totals(totals, pos, date_col, ky_hieu, gia_ban, so_luong, tien_hang_goc, tien_thue_goc):
+    """Bộ cộng dồn của các dòng không lấy hóa đơn tại pos (một mặt hàng), giống accumulate_no_invoice_row cộng lần lượt từng dòng."""
+    totals["so_dong"] = len(pos)
+    totals["ngay"], totals["ky_hieu"] = date_col[pos[0]], ky_hieu[pos[0]] # Date, Symbol (from first row)
+    totals["gia_ban_max"] = max(gia_ban[pos].tolist())
+    totals["so_luong"] = _sequential_sum(so_luong[pos])
+    totals["tien_hang"] = _sequential_sum(tien_hang_goc[pos])
+    totals["tien_thue"] = _sequential_sum(tien_thue_goc[pos])
+
+def _rows_from_columns(columns, positions):
+    """Ghép các cột (mảng hoặc hằng số, theo thứ tự trường của UpsseRow) thành các UpsseRow tại các vị trí positions."""
+    n = len(positions)
+    cols = [repeat(c, n) if not isinstance(c, np.ndarray) else c[positions].tolist() for c in columns]
+    return list(map(UpsseRow, *cols))
+
+# --- Engine tính theo cột (pandas/NumPy) ---
+def build_invoice_rows_vectorized(bkhd_rows, rules, by_day=False):
+    """
+    Cùng đầu vào và kết quả với upsse_core.build_invoice_rows, nhưng các trường được tính theo cột trên DataFrame:
+    tra cứu Data.xlsx bằng map, dòng TMT và tổng hợp không lấy hóa đơn lấy theo mặt nạ boolean.
+    """
+    g5_value = rules.g5
+    df = pd.DataFrame(list(bkhd_rows), dtype=object)
+    if df.empty:
+        return [], [], {} if by_day else {p: new_no_invoice_totals() for p in NO_INVOICE_PRODUCTS}
+
+    ten_kh = _map_values(df[5], _clean_string)
+    ma_kh = _map_values(df[4], _clean_string)
+    co_ma_kh = (df[14] == 'Yes').to_numpy() & df[4].map(bool).to_numpy(dtype=bool) & (ma_kh != '').to_numpy()
+    ma_khach = np.where(co_ma_kh, ma_kh.to_numpy(), np.array(g5_value, dtype=object))
+
+    b_orig, c_orig = _map_values(df[1], _clean_string), _map_values(df[2], _clean_string)
+    so_hd = (rules.so_hd_prefix if rules.so_hd_prefix is not None else b_orig.str[-2:]) + c_orig.str[-6:]
+    ky_hieu = ("1" + b_orig).where(b_orig != '', '')
+    dien_giai = "Xuất bán lẻ theo hóa đơn số " + so_hd
+
+    product_name = _map_values(df[8], _clean_string)
+    product_key = product_name.str.lower()
+    ma_hang = _map_values(product_key, lambda k: rules.product(k)[0])
+    vu_viec = _map_values(product_key, lambda k: rules.product(k)[1])
+    tmt_value = np.array(_map_values(product_key, lambda k: rules.product(k)[2]).tolist(), dtype=float)
+
+    so_luong = _float_column(df[9])
+    gia_ban = np.array([round(x, 2) for x in (_float_column(df[10]) / 1.1 - tmt_value).tolist()], dtype=float) # round() của Python, không dùng np.round
+    tien_hang_goc, tien_thue_goc = _float_column(df[11]), _float_column(df[12])
+    tien_hang = tien_hang_goc - np.rint(tmt_value * so_luong) # rint làm tròn nửa về số chẵn giống round()
+    tien_thue = tien_thue_goc - np.rint(so_luong * tmt_value * 0.1)
+
+    no_invoice = ((ten_kh == "Người mua không lấy hóa đơn") & product_name.isin(NO_INVOICE_PRODUCTS)).to_numpy()
+    regular_pos = np.flatnonzero(~no_invoice)
+    tmt_pos = np.flatnonzero(~no_invoice & (tmt_value > 0) & (so_luong > 0))
+
+    ten_kh, date_col = ten_kh.to_numpy(), df[3].to_numpy()
+    so_hd, ky_hieu = so_hd.to_numpy(), ky_hieu.to_numpy()
+    vu_viec = vu_viec.to_numpy()
+
+    regular_columns = [ma_khach, ten_kh, date_col, so_hd, ky_hieu, dien_giai.to_numpy(), ma_hang.to_numpy(), product_name.to_numpy(),
+                       so_luong, gia_ban, tien_hang, rules.tk_dt_regular, vu_viec, ten_kh, df[6].to_numpy(), df[7].to_numpy(), tien_thue, rules]
+    tmt_columns = [ma_khach, ten_kh, date_col, so_hd, ky_hieu, '', "TMT", "Thuế bảo vệ môi trường",
+                   so_luong, tmt_value, np.rint(tmt_value * so_luong), rules.tk_dt_tmt, vu_viec, "", '', '', np.rint(tmt_value * so_luong * 0.1), rules]
+
+    product_arr = product_name.to_numpy()
+    no_invoice_pos = np.flatnonzero(no_invoice)
+    if by_day: # Nhóm (ngày, ký hiệu) theo thứ tự xuất hiện; factorize coi các giá trị bằng nhau là một như khóa dict của engine loop
+        day_codes, _ = pd.factorize(date_col[no_invoice_pos], use_na_sentinel=False)
+        symbol_codes, symbols = pd.factorize(ky_hieu[no_invoice_pos], use_na_sentinel=False)
+        group_codes = day_codes * len(symbols) + symbol_codes
+        group_ids, first_pos = np.unique(group_codes, return_index=True)
+        group_positions = [no_invoice_pos[group_codes == g] for g in group_ids[np.argsort(first_pos)]]
+    else:
+        group_positions = [no_invoice_pos]
+    no_invoice_totals = {}
+    for group_pos in group_positions:
+        group = {p: new_no_invoice_totals() for p in NO_INVOICE_PRODUCTS}
+        for p, totals in group.items():
+            pos = group_pos[product_arr[group_pos] == p]
+            if len(pos): _fill_no_invoice_totals(totals, pos, date_col, ky_hieu, gia_ban, so_luong, tien_hang_goc, tien_thue_goc)
+        if not by_day: no_invoice_totals = group
+        else: no_invoice_totals[(date_col[group_pos[0]], ky_hieu[group_pos[0]])] = group
+
+    return _rows_from_columns(regular_columns, regular_pos), _rows_from_columns(tmt_columns, tmt_pos), no_invoice_totals
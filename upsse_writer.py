@@ -0,0 +1,193 @@
+import csv
+import io
+from datetime import date, datetime
+from copy import copy
+
+# --- Định dạng các cột của file UpSSE.xlsx (số thứ tự cột tính từ 1) ---
+DATE_COL = 3 # Cột C "Ngày"
+FORCED_TEXT_COLS = {18, 19, 20, 21, 22} # Mã thuế, Tk nợ, Tk doanh thu, Tk giá vốn, Tk thuế có: luôn định dạng '@'
+EXCLUDE_TEXT_COLS = {3, 13, 14, 15, 18, 19, 20, 21, 22, 37} # Các cột không áp dụng text_style
+COLUMN_WIDTHS = {'B': 35, 'C': 12, 'D': 12}
+BLANK_LEADING_ROWS = 4 # SSE yêu cầu 4 dòng trống trước dòng tiêu đề
+NUMBER_COLS = {13, 14, 15, 37} # Số lượng, Giá bán, Tiền hàng, Tiền thuế: các cột còn lại (trừ Ngày) là chữ trong CSV/TSV/Parquet
+PARQUET_ROW_GROUP_SIZE = 50000 # Số dòng mỗi row group khi ghi Parquet
+CANCEL_CHECK_ROWS = 1000 # Số dòng giữa hai lần gọi cancel_check khi đọc bảng kê và ghi file (dừng công việc đã bị hủy)
+
+_NOT_PARSED = object()
+
+def _date_parser():
+    """Hàm đổi giá trị cột Ngày thành date (None nếu không đọc được); ngày dạng chuỗi lặp lại rất nhiều nên chỉ strptime một lần cho mỗi giá trị."""
+    parsed_dates = {}
+
+    def to_date(value):
+        if type(value) is date: return value
+        if not isinstance(value, str): return None # datetime/số... giữ nguyên như trước đây
+        parsed = parsed_dates.get(value, _NOT_PARSED)
+        if parsed is _NOT_PARSED:
+            try: parsed = datetime.strptime(' '.join(value.split()), '%Y-%m-%d').date()
+            except ValueError: parsed = None
+            parsed_dates[value] = parsed
+        return parsed
+    return to_date
+
+# --- Hàm ghi file UpSSE.xlsx ở chế độ write-only ---
+def write_upsse_xlsx(headers, rows, output, cancel_check=None):
+    """
+    Ghi file UpSSE.xlsx theo chế độ write-only (ghi dòng nào xong dòng đó).
+    Mỗi ô được gán kiểu và định dạng ngay khi tạo, thay cho việc duyệt lại toàn bộ sheet sau khi ghi.
+    Kết quả giống hệt cách làm cũ: 4 dòng trống, dòng tiêu đề, text_style cho các cột chữ,
+    date_style cho cột Ngày và định dạng '@' cho các cột R..V. rows là các UpsseRow, chỉ được chuyển thành ô tại đây.
+    cancel_check(), nếu có, được gọi sau mỗi CANCEL_CHECK_ROWS dòng và có thể ném lỗi để dừng giữa chừng.
+    """
+    from openpyxl import Workbook # Nạp khi ghi file (openpyxl kéo theo numpy, chậm lúc khởi động)
+    from openpyxl.cell import WriteOnlyCell
+    from openpyxl.styles import NamedStyle
+    from openpyxl.utils import get_column_letter
+
+    wb = Workbook(write_only=True)
+    text_style = NamedStyle(name="text_style", number_format='@')
+    date_style = NamedStyle(name="date_style", number_format='DD/MM/YYYY')
+    wb.add_named_style(text_style)
+    wb.add_named_style(date_style)
+
+    ws = wb.create_sheet()
+    # Gán NamedStyle cho từng ô phải dò lại danh sách style của workbook, nên chỉ gán một lần cho ô mẫu rồi sao chép
+    text_cell, date_cell, forced_text_cell = WriteOnlyCell(ws), WriteOnlyCell(ws), WriteOnlyCell(ws)
+    text_cell.style, date_cell.style = text_style, date_style
+    forced_text_cell.number_format = '@'
+    for col_letter, width in COLUMN_WIDTHS.items():
+        ws.column_dimensions[col_letter].width = width
+    # Sheet write-only không tự ghi thẻ <dimension>, khai báo trước vì SSE đọc theo kích thước sheet
+    last_row = BLANK_LEADING_ROWS + 1 + len(rows)
+    ws.calculate_dimension = lambda: f"A1:{get_column_letter(len(headers))}{last_row}"
+
+    to_date = _date_parser()
+
+    def make_cells(values):
+        cells = []
+        for c, value in enumerate(values, start=1):
+            if c in FORCED_TEXT_COLS:
+                cell = WriteOnlyCell(ws, value)
+                cell._style = copy(forced_text_cell._style)
+            elif not value or (isinstance(value, str) and value.strip() == "None"):
+                cell = value
+            elif c == DATE_COL:
+                parsed = to_date(value)
+                if parsed is None:
+                    cell = value
+                else:
+                    cell = WriteOnlyCell(ws, parsed)
+                    cell._style = copy(date_cell._style)
+            elif c in EXCLUDE_TEXT_COLS:
+                cell = value
+            else:
+                cell = WriteOnlyCell(ws, value)
+                cell._style = copy(text_cell._style)
+            cells.append(cell)
+        return cells
+
+    for _ in range(BLANK_LEADING_ROWS):
+        ws.append(make_cells([''] * len(headers)))
+    ws.append(make_cells(headers))
+    try:
+        for i, row in enumerate(rows, start=1):
+            ws.append(make_cells(row.to_cells()))
+            if cancel_check is not None and i % CANCEL_CHECK_ROWS == 0: cancel_check()
+    except BaseException: # Dừng giữa chừng: đóng sheet và xóa file tạm openpyxl đang ghi dở
+        ws.close()
+        ws._writer.cleanup()
+        raise
+
+    wb.save(output)
+    return output
+
+# --- Ghi CSV/TSV dạng luồng (cho các script đối chiếu, không cần mở lại UpSSE.xlsx) ---
+def _text(value):
+    return "" if value is None else str(value)
+
+def write_upsse_csv(headers, rows, output, cancel_check=None, delimiter=","):
+    """
+    Ghi dòng tiêu đề và các dòng dữ liệu (không có 4 dòng trống của SSE), mã hóa utf-8-sig để Excel hiển thị đúng tiếng Việt.
+    Các cột chữ (Mã khách, Số hóa đơn, Tk nợ, Tk doanh thu, Tk thuế có...) luôn được ghi trong dấu nháy kép, kể cả khi là số,
+    để công cụ đọc giữ nguyên dạng chữ; chỉ các cột NUMBER_COLS không có nháy. Ngày ghi dạng yyyy-mm-dd.
+    cancel_check như write_upsse_xlsx.
+    """
+    to_date = _date_parser()
+    # QUOTE_NONNUMERIC: chuỗi có nháy, số không có nháy; nên đổi sẵn cột chữ thành chuỗi và cột số rỗng thành None
+    columns = [(c in NUMBER_COLS, c == DATE_COL) for c in range(1, len(headers) + 1)]
+    if isinstance(output, str): text_output = open(output, "w", encoding="utf-8-sig", newline="")
+    else: text_output = io.TextIOWrapper(output, encoding="utf-8-sig", newline="")
+    try:
+        writer = csv.writer(text_output, delimiter=delimiter, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(headers)
+        for i, row in enumerate(rows, start=1):
+            if cancel_check is not None and i % CANCEL_CHECK_ROWS == 0: cancel_check()
+            values = []
+            for (is_number, is_date), value in zip(columns, row.to_cells()):
+                if is_number: values.append(value if isinstance(value, (int, float)) else (_text(value) or None))
+                elif is_date:
+                    parsed = to_date(value)
+                    values.append(parsed.isoformat() if parsed else _text(value))
+                else: values.append(_text(value))
+            writer.writerow(values)
+    finally:
+        if isinstance(output, str): text_output.close()
+        else:
+            text_output.flush()
+            text_output.detach() # Trả lại output cho người gọi, không đóng nó
+    return output
+
+def write_upsse_tsv(headers, rows, output, cancel_check=None):
+    return write_upsse_csv(headers, rows, output, cancel_check, delimiter="\t")
+
+# --- Ghi Parquet (cho phân tích dữ liệu) ---
+def write_upsse_parquet(headers, rows, output, cancel_check=None):
+    """
+    Ghi các dòng dữ liệu thành Parquet theo từng row group (PARQUET_ROW_GROUP_SIZE dòng): cột chữ kiểu string,
+    cột NUMBER_COLS kiểu double, cột Ngày kiểu date32 (string nếu có ngày không đọc được). Cần pyarrow (cài kèm streamlit).
+    cancel_check như write_upsse_xlsx, được gọi trước mỗi row group.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    to_date = _date_parser()
+    dates = [to_date(row.ngay) for row in rows]
+    date_type = pa.date32() if all(d is not None or not row.ngay for d, row in zip(dates, rows)) else pa.string()
+    schema = pa.schema([(h, pa.float64() if c in NUMBER_COLS else date_type if c == DATE_COL else pa.string())
+                        for c, h in enumerate(headers, start=1)])
+
+    def column(c, cells):
+        if c in NUMBER_COLS: return [v if isinstance(v, (int, float)) else None for v in cells]
+        if c == DATE_COL and date_type == pa.date32(): return [to_date(v) for v in cells]
+        return [None if v is None else str(v) for v in cells]
+
+    with pq.ParquetWriter(output, schema) as writer:
+        for start in range(0, len(rows), PARQUET_ROW_GROUP_SIZE):
+            if cancel_check is not None: cancel_check()
+            cells = [row.to_cells() for row in rows[start:start + PARQUET_ROW_GROUP_SIZE]]
+            writer.write_table(pa.table([column(c, values) for c, values in enumerate(zip(*cells), start=1)], schema=schema))
+        if not rows: writer.write_table(schema.empty_table())
+    return output
+
+# --- Các định dạng file kết quả ---
+class OutputFormat:
+    """
+    Một định dạng file kết quả: write(headers, rows, output, cancel_check=None) ghi các UpsseRow vào output (đường dẫn hoặc file-like nhị phân),
+    gọi cancel_check() định kỳ trong lúc ghi nếu có.
+    """
+    __slots__ = ("name", "extension", "mime", "write")
+
+    def __init__(self, name, extension, mime, write):
+        self.name, self.extension, self.mime, self.write = name, extension, mime, write
+
+OUTPUT_FORMATS = {
+    "xlsx": OutputFormat("xlsx", ".xlsx", "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", write_upsse_xlsx),
+    "csv": OutputFormat("csv", ".csv", "text/csv", write_upsse_csv),
+    "tsv": OutputFormat("tsv", ".tsv", "text/tab-separated-values", write_upsse_tsv),
+    "parquet": OutputFormat("parquet", ".parquet", "application/vnd.apache.parquet", write_upsse_parquet),
+}
+
+def get_output_format(name):
+    """'xlsx' (mặc định, nhập được vào SSE), 'csv', 'tsv' hoặc 'parquet' (cho đối chiếu, phân tích; SSE không nhập được)."""
+    try: return OUTPUT_FORMATS[name]
+    except KeyError: raise ValueError(f"Định dạng không hợp lệ: {name!r} (chọn {', '.join(map(repr, OUTPUT_FORMATS))})") from None